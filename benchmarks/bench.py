@@ -0,0 +1,718 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+"""Benchmark the scanner and the HTTP server on synthetic data.
+
+The benchmark generates in a working directory:
+
+- OCA-like Git repositories (addons on several version branches, with
+  some commits to simulate activity), scanned by the scanner with oca-port
+  stubbed out, to measure the scan throughput;
+- databases of increasing sizes, filled through the write path of the
+  scanner to measure the cost of writing a module, then queried through
+  the HTTP API to measure its latency.
+
+Results are written as JSON, and can be compared to the results of a
+previous run:
+
+    $ python benchmarks/bench.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+BRANCHES = ("14.0", "15.0", "16.0")
+BRANCHES_MATRIX = [("14.0", "15.0"), ("14.0", "16.0"), ("15.0", "16.0")]
+# Number of modules of each repository in the generated databases
+MODULES_PER_REPOSITORY = 100
+# Number of modules of the CSV reports
+REPORT_SIZE = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workdir", help="Working directory (temporary by default)"
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark-results.json",
+        help="JSON file storing the results",
+    )
+    parser.add_argument(
+        "--compare", help="JSON results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--repositories",
+        type=int,
+        default=5,
+        help="Number of Git repositories to scan",
+    )
+    parser.add_argument(
+        "--addons", type=int, default=50, help="Number of addons per branch"
+    )
+    parser.add_argument(
+        "--churn",
+        type=int,
+        default=20,
+        help="Number of commits added on each branch between two scans",
+    )
+    parser.add_argument(
+        "--analysis-delay",
+        type=float,
+        default=0,
+        help="Time spent by the oca-port stub to analyze a module",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="Comma-separated numbers of modules of the databases",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=50,
+        help="Number of requests sent to measure each endpoint",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of concurrent requests",
+    )
+    args = parser.parse_args()
+    with _get_workdir(args.workdir) as workdir:
+        # The configuration is read from these folders
+        os.environ["XDG_CONFIG_HOME"] = str(workdir / "config")
+        os.environ["XDG_DATA_HOME"] = str(workdir / "data")
+        results = {
+            "meta": _get_meta(args),
+            "scan": bench_scan(workdir, args),
+            "databases": {},
+        }
+        for size in [int(size) for size in args.sizes.split(",")]:
+            results["databases"][str(size)] = bench_database(
+                workdir, size, args
+            )
+    with open(args.output, "w") as file_:
+        json.dump(results, file_, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as file_:
+            _compare(json.load(file_), results)
+
+
+@contextlib.contextmanager
+def _get_workdir(path):
+    if path:
+        path = pathlib.Path(path).resolve()
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        yield path
+    else:
+        with tempfile.TemporaryDirectory() as path:
+            yield pathlib.Path(path)
+
+
+def _get_meta(args):
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=pathlib.Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "args": vars(args),
+    }
+
+
+# Scan
+
+
+class FakeOcaPortApp:
+    """Replacement of `oca_port.App`, returning results without analysis.
+
+    Results only depend on the analyzed module, and are spread among the
+    possible outcomes of oca-port.
+    """
+
+    delay = 0
+
+    def __init__(self, **params):
+        self.params = params
+
+    def run(self):
+        time.sleep(self.delay)
+        addon = self.params["addon"]
+        outcome = int(hashlib.md5(addon.encode()).hexdigest(), 16) % 4
+        if outcome == 0:
+            return json.dumps({"process": None, "results": {}})
+        if outcome == 1:
+            return json.dumps({"process": "migrate", "results": {}})
+        if outcome == 2:
+            pr = {
+                "title": f"[16.0][MIG] {addon}",
+                "number": 1,
+                "url": f"https://github.com/OCA/repo/pull/{addon}",
+                "author": "bench",
+                "merged_at": None,
+            }
+            return json.dumps(
+                {"process": "migrate", "results": {"existing_pr": pr}}
+            )
+        results = {
+            str(number): {
+                "url": f"https://github.com/OCA/repo/pull/{number}",
+                "missing_commits": [f"{number:040x}"] * number,
+            }
+            for number in (1, 2)
+        }
+        return json.dumps({"process": "port_commits", "results": results})
+
+
+def bench_scan(workdir, args):
+    """Measure the scan of generated repositories, then of their updates."""
+    from oca_port_scanner import config
+
+    remotes_path = workdir / "remotes"
+    storage_path = workdir / "repositories"
+    repositories = [f"OCA/bench-{i}" for i in range(args.repositories)]
+    config_ = config.Config()
+    config_.update(
+        {
+            "options": {
+                "repositories_path": str(storage_path),
+                "database_path": str(workdir / "scan.db"),
+                "workers": 1,
+                # The oca-port stub is not available in other processes
+                "analysis_workers": 1,
+            },
+            "branches_matrix": BRANCHES_MATRIX,
+            "repositories": repositories,
+        }
+    )
+    config_path = config.Config._get_config_path()
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    config_path.write_text(json.dumps(config_))
+    rand = random.Random(0)
+    start = time.perf_counter()
+    for name in repositories:
+        remote = remotes_path / f"{name}.git"
+        subprocess.run(["git", "init", "-q", "--bare", remote], check=True)
+        _import_commits(remote, _generate_repository(args, rand))
+        subprocess.run(
+            ["git", "clone", "-q", remote, storage_path / name], check=True
+        )
+    generation_time = time.perf_counter() - start
+
+    import oca_port
+
+    from oca_port_scanner.scanner import app
+
+    oca_port.App = FakeOcaPortApp
+    FakeOcaPortApp.delay = args.analysis_delay
+    scanner = app.App()
+    results = {"generation_seconds": generation_time}
+    results["initial"] = _measure_scan(scanner)
+    for name in repositories:
+        _import_commits(
+            remotes_path / f"{name}.git", _generate_churn(args, rand)
+        )
+    results["update"] = _measure_scan(scanner)
+    results["idle"] = _measure_scan(scanner)
+    return results
+
+
+def _measure_scan(scanner):
+    """Scan all repositories, and return the time and modules analyzed."""
+    # Make all repositories due
+    with scanner.backend.transaction() as cr:
+        cr.execute("DELETE FROM scan_schedule;")
+    analyses = _get_analyses_count()
+    start = time.perf_counter()
+    scanner._scan_repositories()
+    duration = time.perf_counter() - start
+    analyses = {
+        result: count - analyses.get(result, 0)
+        for result, count in _get_analyses_count().items()
+    }
+    return {
+        "seconds": duration,
+        "analyses": analyses.get("miss", 0),
+        "cache_hits": analyses.get("hit", 0),
+        "modules_per_second": analyses.get("miss", 0) / duration,
+    }
+
+
+def _get_analyses_count():
+    from oca_port_scanner.scanner import repo
+
+    return {
+        dict(key)["result"]: count
+        for key, count in repo.ANALYSES._values.items()
+    }
+
+
+def _generate_repository(args, rand):
+    """Return a `git fast-import` stream creating the version branches."""
+    commands = []
+    for branch in BRANCHES:
+        files = {
+            f"{addon}/{path}": content
+            for i in range(args.addons)
+            for addon in [f"{branch.replace('.', '_')}_addon_{i}"]
+            if rand.random() < 0.9 or branch == BRANCHES[0]
+            for path, content in _generate_addon(addon, branch).items()
+        }
+        files["setup/README"] = "Setup"
+        commands.append(_get_commit(branch, "Initial commit", files))
+    return "".join(commands)
+
+
+def _generate_churn(args, rand):
+    """Return a `git fast-import` stream updating addons on each branch."""
+    commands = []
+    for branch in BRANCHES:
+        for number in range(args.churn):
+            addon = f"{branch.replace('.', '_')}_addon_" + str(
+                rand.randrange(args.addons)
+            )
+            path = rand.choice(["models/model.py", "i18n/fr.po"])
+            files = {f"{addon}/{path}": f"# Update {number}\n"}
+            commands.append(
+                _get_commit(
+                    branch,
+                    f"[IMP] {addon}",
+                    files,
+                    # Continue the branch existing in the repository
+                    parent=f"refs/heads/{branch}^0" if not number else None,
+                )
+            )
+    return "".join(commands)
+
+
+def _generate_addon(addon, branch):
+    return {
+        "__init__.py": "from . import models\n",
+        "__manifest__.py": str({"name": addon, "version": f"{branch}.1.0.0"}),
+        "models/__init__.py": "from . import model\n",
+        "models/model.py": f"# Model of {addon}\n",
+        "i18n/fr.po": f"# Translation of {addon}\n",
+    }
+
+
+def _get_commit(branch, message, files, parent=None):
+    lines = [
+        f"commit refs/heads/{branch}",
+        "committer Bench <bench@example.com> 1700000000 +0000",
+        _get_data(message),
+    ]
+    if parent:
+        lines.append(f"from {parent}")
+    for path, content in files.items():
+        lines.append(f"M 100644 inline {path}")
+        lines.append(_get_data(content))
+    return "\n".join(lines) + "\n"
+
+
+def _get_data(content):
+    return f"data {len(content.encode())}\n{content}"
+
+
+def _import_commits(repository, stream):
+    subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        cwd=repository,
+        input=stream.encode(),
+        check=True,
+    )
+
+
+# Databases
+
+
+def bench_database(workdir, size, args):
+    """Measure the writes to a database of `size` modules, then reads."""
+    from oca_port_scanner import backend, config
+
+    config_ = config.Config()
+    config_.update(
+        {
+            "options": {
+                "database_path": str(workdir / f"modules-{size}.db"),
+            },
+            "branches_matrix": BRANCHES_MATRIX,
+            "repositories": [],
+        }
+    )
+    backend_ = backend.Backend(config_, check_same_thread=False)
+    results = {"write": _fill_database(backend_, workdir, size)}
+    results["api"] = asyncio.run(_bench_api(backend_, args))
+    return results
+
+
+def _get_repo(backend_, workdir, name):
+    """Return a `Repo` of the scanner, only able to write its results."""
+    from oca_port_scanner.scanner import repo
+
+    app = types.SimpleNamespace(
+        backend=backend_,
+        storage=types.SimpleNamespace(repositories_path=workdir),
+    )
+    return repo.Repo(app, name)
+
+
+def _get_modules_data(repository, size, rand):
+    """Return oca-port results of `size` modules of `repository`."""
+    modules_data = {}
+    for i in range(size):
+        module = f"{repository.techname.replace('-', '_')}_module_{i}"
+        json_data = FakeOcaPortApp(addon=module + str(rand.random())).run()
+        modules_data[module] = json.loads(json_data)
+    return modules_data
+
+
+def _fill_database(backend_, workdir, size):
+    """Write `size` modules through the write path of the scanner."""
+    rand = random.Random(size)
+    nb_repositories = max(size // (MODULES_PER_REPOSITORY * 3), 1)
+    pair_size = size // (nb_repositories * 3)
+    repositories = [
+        _get_repo(backend_, workdir, f"OCA/bench-{i}")
+        for i in range(nb_repositories)
+    ]
+    insert_time = 0
+    for repository in repositories:
+        for from_branch, to_branch in BRANCHES_MATRIX:
+            modules_data = _get_modules_data(repository, pair_size, rand)
+            start = time.perf_counter()
+            repository._save_scan_results(
+                from_branch, to_branch, modules_data, {}, "a", "b"
+            )
+            insert_time += time.perf_counter() - start
+    nb_modules = nb_repositories * 3 * pair_size
+    # Scan again a tenth of the repositories, changing their results
+    update_time = nb_updated = 0
+    for repository in repositories[: max(nb_repositories // 10, 1)]:
+        for from_branch, to_branch in BRANCHES_MATRIX:
+            modules_data = _get_modules_data(repository, pair_size, rand)
+            start = time.perf_counter()
+            repository._save_scan_results(
+                from_branch, to_branch, modules_data, {}, "c", "d"
+            )
+            update_time += time.perf_counter() - start
+            nb_updated += pair_size
+    return {
+        "modules": nb_modules,
+        "insert_seconds": insert_time,
+        "insert_us_per_module": insert_time / nb_modules * 1e6,
+        "update_us_per_module": update_time / nb_updated * 1e6,
+        "database_bytes": backend_.db_path.stat().st_size,
+    }
+
+
+async def _bench_api(backend_, args):
+    """Measure the latency of the HTTP API on the database of `backend_`."""
+    import httpx
+
+    from oca_port_scanner import http
+    from oca_port_scanner.http import models
+
+    # Serve the generated database, without caching responses
+    models.backend = http.backend = backend_
+    http.response_cache.size = 0
+    queries = _count_queries(backend_)
+    module_names = _get_report_modules(backend_)
+    endpoints = {
+        "versions": ("GET", "/api/versions", {}),
+        "repositories_page": ("GET", "/api/repositories", {"limit": 100}),
+        "modules_page": ("GET", "/api/modules", {"limit": 100}),
+        "modules_pair": (
+            "GET",
+            "/api/modules",
+            {"from_version": "14.0", "to_version": "16.0"},
+        ),
+        "modules_projection": (
+            "GET",
+            "/api/modules",
+            {"fields": "name,status", "limit": 1000},
+        ),
+        "report": (
+            "POST",
+            "/report",
+            {"versions": "14.0,16.0", "modules": " ".join(module_names)},
+        ),
+    }
+    results = {}
+    transport = httpx.ASGITransport(app=http.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        for name, (method, url, params) in endpoints.items():
+            nb_requests = args.requests
+            if name == "modules_pair":
+                nb_requests = max(args.requests // 10, 1)
+            queries["count"] = 0
+            latencies, response = await _measure_requests(
+                client, method, url, params, nb_requests
+            )
+            results[name] = _get_latency_stats(latencies)
+            results[name]["queries"] = queries["count"] / nb_requests
+            if name == "modules_pair":
+                nb_rows = len(response.json())
+                results[name]["rows_per_second"] = nb_rows / (
+                    sum(latencies) / len(latencies)
+                )
+        # Latency while the scanner is writing
+        with _write_continuously(backend_):
+            latencies, __ = await _measure_requests(
+                client, *endpoints["modules_page"], args.requests
+            )
+        results["modules_page_under_writes"] = _get_latency_stats(latencies)
+        results["concurrency"] = await _bench_concurrency(
+            client, backend_, args
+        )
+        # Pages not modified since the last request of the client
+        http.response_cache.size = 256
+        response = await client.get("/api/modules", params={"limit": 100})
+        headers = {"If-None-Match": response.headers["ETag"]}
+        latencies = []
+        for __ in range(args.requests):
+            start = time.perf_counter()
+            await client.get(
+                "/api/modules", params={"limit": 100}, headers=headers
+            )
+            latencies.append(time.perf_counter() - start)
+        results["modules_page_not_modified"] = _get_latency_stats(latencies)
+    return results
+
+
+async def _bench_concurrency(client, backend_, args):
+    """Measure the API while slow searches are running concurrently.
+
+    Searches rank all the modules sharing trigrams with the query, which
+    mostly runs in SQLite, releasing the GIL: concurrent searches overlap
+    as long as CPUs and readers are available. Whatever the number of
+    CPUs, a quick request is served while searches use all readers but
+    one, which is compared to running the queries on the event loop.
+    """
+    from oca_port_scanner import http
+
+    search = {"q": "module"}
+    start = time.perf_counter()
+    for __ in range(args.concurrency):
+        (await client.get("/api/search", params=search)).raise_for_status()
+    sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    responses = await asyncio.gather(
+        *[
+            client.get("/api/search", params=search)
+            for __ in range(args.concurrency)
+        ]
+    )
+    concurrent = time.perf_counter() - start
+    for response in responses:
+        response.raise_for_status()
+    results = {
+        "requests": args.concurrency,
+        "cpus": os.cpu_count(),
+        "sequential_seconds": sequential,
+        "concurrent_seconds": concurrent,
+        "speedup": sequential / concurrent,
+    }
+
+    async def measure_quick_requests():
+        latencies = []
+        for __ in range(max(args.requests // 10, 1)):
+            start = time.perf_counter()
+            searches = [
+                asyncio.create_task(client.get("/api/search", params=search))
+                for __ in range(backend_.readers_size - 1)
+            ]
+            # Sent just after the searches, run first by the event loop
+            response = await asyncio.create_task(client.get("/api/versions"))
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+            await asyncio.gather(*searches)
+        return _get_latency_stats(latencies)
+
+    results["versions_during_searches"] = await measure_quick_requests()
+
+    async def run_query_blocking(func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    run_query = http.run_query
+    http.run_query = run_query_blocking
+    try:
+        results[
+            "versions_during_searches_blocking"
+        ] = await measure_quick_requests()
+    finally:
+        http.run_query = run_query
+    return results
+
+
+async def _measure_requests(client, method, url, params, nb_requests):
+    latencies = []
+    for __ in range(nb_requests):
+        start = time.perf_counter()
+        if method == "POST":
+            response = await client.post(url, data=params)
+        else:
+            response = await client.get(url, params=params)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latencies, response
+
+
+def _get_latency_stats(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    return {
+        "requests": len(latencies),
+        "p50_ms": percentile(0.5) * 1000,
+        "p95_ms": percentile(0.95) * 1000,
+        "p99_ms": percentile(0.99) * 1000,
+    }
+
+
+def _count_queries(backend_):
+    """Count the queries run by the read-only connections of `backend_`.
+
+    Return a dictionary whose 'count' key is incremented by each statement
+    executed by the API, an `executemany()` counting once. Statements run
+    by SQLite on its own (triggers, full-text index) are not counted.
+    """
+    queries = {"count": 0}
+    connect = backend_._connect
+
+    def _connect(readonly=False, **kwargs):
+        con = connect(readonly=readonly, **kwargs)
+        if readonly:
+            con = _CountingConnection(con, queries)
+        return con
+
+    backend_._connect = _connect
+    return queries
+
+
+class _CountingConnection:
+    """Wrap a connection to count the statements run by its cursors."""
+
+    def __init__(self, con, queries):
+        self._con = con
+        self._queries = queries
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def cursor(self):
+        return _CountingCursor(self._con.cursor(), self._queries)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+
+class _CountingCursor:
+    def __init__(self, cr, queries):
+        self._cr = cr
+        self._queries = queries
+
+    def __getattr__(self, name):
+        return getattr(self._cr, name)
+
+    def __iter__(self):
+        return iter(self._cr)
+
+    def execute(self, *args):
+        self._queries["count"] += 1
+        self._cr.execute(*args)
+        return self
+
+    def executemany(self, *args):
+        self._queries["count"] += 1
+        self._cr.executemany(*args)
+        return self
+
+
+def _get_report_modules(backend_):
+    """Return the names of modules of a report, some of them unknown."""
+    with backend_.reader() as cr:
+        cr.execute(
+            "SELECT module FROM modules WHERE from_version=? LIMIT ?;",
+            ("14.0", REPORT_SIZE * 9 // 10),
+        )
+        names = [row[0] for row in cr.fetchall()]
+    return names + [f"unknown_{i}" for i in range(REPORT_SIZE // 10)]
+
+
+@contextlib.contextmanager
+def _write_continuously(backend_):
+    """Save scan results in a thread, as the scanner would do."""
+    stop = threading.Event()
+    repository = _get_repo(backend_, pathlib.Path("."), "OCA/bench-0")
+
+    def write():
+        rand = random.Random(0)
+        while not stop.is_set():
+            modules_data = _get_modules_data(repository, 50, rand)
+            repository._save_scan_results(
+                "14.0", "16.0", modules_data, {}, "e", "f"
+            )
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+# Comparison
+
+
+def _compare(before, after):
+    """Print the relative change of the numeric results."""
+    before, after = _flatten(before), _flatten(after)
+    print(f"{'result':<60} {'before':>12} {'after':>12} {'change':>8}")
+    for key, value in after.items():
+        if key.startswith("meta.") or key not in before:
+            continue
+        change = (value - before[key]) / before[key] if before[key] else 0
+        print(f"{key:<60} {before[key]:>12.2f} {value:>12.2f} {change:>+8.0%}")
+
+
+def _flatten(data, prefix=""):
+    items = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            items.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[f"{prefix}{key}"] = value
+    return items
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,189 @@
 # Copyright 2023 Camptocamp SA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
 
+import contextlib
+import json
 import pathlib
+import queue
 import sqlite3
+import threading
+
+# Default pragmas applied to each connection, can be overridden with the
+# 'database_pragmas' option
+DEFAULT_PRAGMAS = {
+    # Readers do not block the writer (and vice versa) in WAL mode
+    "journal_mode": "wal",
+    # Safe with WAL: only the last transactions could be lost on power loss
+    "synchronous": "normal",
+    # Negative value: size in KiB (64MiB)
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "busy_timeout": 5000,
+}
+
+
+# Fields of the existing PRs of modules, as serialized by the API
+PR_FIELDS = ("title", "number", "url", "author", "merged_at")
+
+
+def get_pr_data(existing_pr):
+    """Return the PR data stored as JSON with the fields of `PR_FIELDS`."""
+    pr_data = json.loads(existing_pr) if existing_pr else None
+    if not pr_data:
+        return None
+    return {field: pr_data.get(field) for field in PR_FIELDS}
+
+
+def compute_module_status(process, results):
+    """Return the status of a module from the results of its analysis.
+
+    Return a tuple `(status, nb_missing_commits, pr_urls)`, `pr_urls` being
+    the URLs (one per line) of the PR to review or of the PRs to port
+    commits from.
+    """
+    if not process:
+        return "available", 0, None
+    existing_pr = results.get("existing_pr")
+    if process == "migrate" and existing_pr:
+        return "to review", 0, existing_pr.get("url")
+    if process == "port_commits":
+        prs = list(results.values())
+        nb_missing_commits = sum(
+            len(pr.get("missing_commits", [])) for pr in prs
+        )
+        pr_urls = "\n".join(pr["url"] for pr in prs if pr.get("url"))
+        return process, nb_missing_commits, pr_urls
+    return process, 0, None
 
 
 class Backend:
     """Manage the SQLite3 database."""
 
+    # Conditions counting a module in each repository stats column
+    _repositories_stats = {
+        "nb_modules": "1",
+        "nb_modules_migrated": "{m}.status IN ('available', 'port_commits')",
+        "nb_modules_to_migrate": "{m}.status = 'migrate'",
+        "nb_modules_to_review": "{m}.status = 'to review'",
+        "nb_modules_to_port_commits": "{m}.status = 'port_commits'",
+    }
+    # Conditions used before the modules status was stored, frozen for the
+    # migrations relying on them
+    _legacy_repositories_stats = {
+        "nb_modules": "1",
+        "nb_modules_migrated": (
+            "{m}.process IS NULL OR {m}.process = 'port_commits'"
+        ),
+        "nb_modules_to_migrate": (
+            "{m}.process = 'migrate'"
+            " AND IFNULL({m}.results, '') NOT LIKE '%existing_pr%'"
+        ),
+        "nb_modules_to_review": (
+            "{m}.process = 'migrate' AND {m}.results LIKE '%existing_pr%'"
+        ),
+        "nb_modules_to_port_commits": "{m}.process = 'port_commits'",
+    }
+
     def __init__(self, config, check_same_thread=True):
         self.config = config
         self.db_path = pathlib.Path(self.config["options"]["database_path"])
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self.db = sqlite3.connect(
-            self.db_path, check_same_thread=check_same_thread
+        self.pragmas = dict(
+            DEFAULT_PRAGMAS,
+            **self.config["options"].get("database_pragmas", {}),
         )
+        self.db = self._connect(check_same_thread=check_same_thread)
+        # Fire delete triggers when 'INSERT OR REPLACE' removes a row, so
+        # repository stats are kept up-to-date
+        self.db.execute("PRAGMA recursive_triggers = ON;")
+        # Serialize the accesses to the connection shared between threads,
+        # making it the single writer of the database
+        self._lock = threading.RLock()
         self._init_db()
+        # Pool of read-only connections, opened on demand
+        self._readers = queue.LifoQueue()
+        self.readers_size = self.config["options"].get("database_readers", 4)
+        self._readers_count = 0
+        self._readers_lock = threading.Lock()
+
+    def _connect(self, readonly=False, check_same_thread=True):
+        """Open a connection to the database configured with the pragmas."""
+        uri = self.db_path.resolve().as_uri()
+        if readonly:
+            uri = f"{uri}?mode=ro"
+        con = sqlite3.connect(
+            uri, uri=True, check_same_thread=check_same_thread
+        )
+        for pragma, value in self.pragmas.items():
+            # The journal mode is persistent and is set by the writer
+            if readonly and pragma == "journal_mode":
+                continue
+            con.execute(f"PRAGMA {pragma} = {value};")
+        return con
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Return a cursor on a read-only connection of the pool.
+
+        Readers can be used from any thread, and run concurrently with
+        the writer connection.
+        """
+        try:
+            con = self._readers.get_nowait()
+        except queue.Empty:
+            with self._readers_lock:
+                open_reader = self._readers_count < self.readers_size
+                if open_reader:
+                    self._readers_count += 1
+            if open_reader:
+                con = self._connect(readonly=True, check_same_thread=False)
+            else:
+                con = self._readers.get()
+        try:
+            yield con.cursor()
+        finally:
+            self._readers.put(con)
+
+    @contextlib.contextmanager
+    def temp_table(self, cr, name, columns, rows):
+        """Load `rows` in the temporary table `name` during the block.
+
+        Temporary tables are private to the connection of `cr`, even a
+        read-only one, and can be joined with large lists of values
+        instead of binding each of them as a parameter of the query.
+        """
+        placeholders = ", ".join(["?"] * len(columns))
+        cr.execute(f"CREATE TEMP TABLE {name} ({', '.join(columns)});")
+        try:
+            cr.executemany(
+                f"INSERT INTO temp.{name} VALUES ({placeholders});", rows
+            )
+            yield
+        finally:
+            cr.execute(f"DROP TABLE temp.{name};")
+            # End the transaction opened by the inserts, otherwise the
+            # connection would keep reading the same snapshot of the data
+            cr.connection.commit()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Return a cursor whose queries are committed together on exit.
+
+        The transaction is rolled back if an exception is raised.
+        """
+        with self._lock:
+            cr = self.db.cursor()
+            try:
+                yield cr
+            except Exception:
+                self.db.rollback()
+                raise
+            else:
+                self.db.commit()
 
     def _init_db(self):
         cr = self.db.cursor()
         create_idx = "CREATE INDEX IF NOT EXISTS"
-        repo_stats_trigger_query = """
-            UPDATE repositories
-            SET
-                nb_modules=(
-                    SELECT COUNT(*) FROM modules m
-                    WHERE m.org=repositories.org
-                    AND m.repo=repositories.name
-                    AND m.from_version=repositories.from_version
-                    AND m.to_version=repositories.to_version
-                ),
-                nb_modules_migrated=(
-                    SELECT COUNT(*) FROM modules m
-                    WHERE m.org=repositories.org
-                    AND m.repo=repositories.name
-                    AND m.from_version=repositories.from_version
-                    AND m.to_version=repositories.to_version
-                    AND (process IS NULL OR process = 'port_commits')
-                ),
-                nb_modules_to_migrate=(
-                    SELECT COUNT(*) FROM modules m
-                    WHERE m.org=repositories.org
-                    AND m.repo=repositories.name
-                    AND m.from_version=repositories.from_version
-                    AND m.to_version=repositories.to_version
-                    AND process = 'migrate'
-                    AND results NOT LIKE '%existing_pr%'
-                ),
-                nb_modules_to_review=(
-                    SELECT COUNT(*) FROM modules m
-                    WHERE m.org=repositories.org
-                    AND m.repo=repositories.name
-                    AND m.from_version=repositories.from_version
-                    AND m.to_version=repositories.to_version
-                    AND process = 'migrate'
-                    AND results LIKE '%existing_pr%'
-                ),
-                nb_modules_to_port_commits=(
-                    SELECT COUNT(*) FROM modules m
-                    WHERE m.org=repositories.org
-                    AND m.repo=repositories.name
-                    AND m.from_version=repositories.from_version
-                    AND m.to_version=repositories.to_version
-                    AND process = 'port_commits'
-                )
-            WHERE org=NEW.org
-            AND name=NEW.repo
-            AND from_version=NEW.from_version
-            AND to_version=NEW.to_version;
-        """
         queries = [
             # repositories
             """
@@ -108,29 +223,511 @@ class Backend:
                 ON DELETE CASCADE
             );
             """,
-            f"{create_idx} migrations_module_index ON modules (module);",
             f"""
             {create_idx} migrations_from_to_version_index
                 ON modules (from_version, to_version);
             """,
             f"{create_idx} migrations_process_index ON modules (process);",
-            # triggers to compute some repository stats
+            # keys of the last oca-port analysis of each module: the results
+            # stored in 'modules' are valid as long as the trees of the
+            # module on both branches and the version of oca-port match
+            """
+            CREATE TABLE IF NOT EXISTS oca_port_cache (
+                org CHAR,
+                repo CHAR,
+                module CHAR,
+                from_version CHAR,
+                to_version CHAR,
+                from_tree CHAR,
+                to_tree CHAR,
+                oca_port_version CHAR,
+                UNIQUE(org, repo, module, from_version, to_version)
+            );
+            """,
+        ]
+        for query in queries:
+            cr.execute(query)
+        self._migrate_db()
+
+    def _migrate_db(self):
+        """Apply pending schema migrations.
+
+        The version of the schema is tracked with the SQLite `user_version`
+        pragma, each migration being applied once in its own transaction.
+        The scanner and the HTTP server both migrate the database when they
+        start: the version is checked once the database is locked, so a
+        migration applied in the meantime by the other process is skipped.
+        """
+        migrations = [
+            self._migrate_incremental_repositories_stats,
+            self._migrate_scan_schedule,
+            self._migrate_scan_jobs,
+            self._migrate_modules_status,
+            self._migrate_scan_generation,
+            self._migrate_versions_stats,
+            self._migrate_metrics,
+            self._migrate_modules_report_index,
+            self._migrate_modules_search,
+        ]
+        cr = self.db.cursor()
+        version = cr.execute("PRAGMA user_version;").fetchone()[0]
+        for number, migration in enumerate(migrations, start=1):
+            if number <= version:
+                continue
+            cr.execute("BEGIN IMMEDIATE;")
+            try:
+                version = cr.execute("PRAGMA user_version;").fetchone()[0]
+                if number > version:
+                    migration(cr)
+                    cr.execute(f"PRAGMA user_version = {number};")
+            except Exception:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def _migrate_incremental_repositories_stats(self, cr):
+        """Replace the full recount triggers by incremental ones."""
+        cr.execute("DROP TRIGGER IF EXISTS repositories_stats_insert_trigger;")
+        cr.execute("DROP TRIGGER IF EXISTS repositories_stats_update_trigger;")
+        stats = self._legacy_repositories_stats
+        self._create_repositories_stats_triggers(cr, stats)
+        self._rebuild_repositories_stats(cr, stats)
+
+    def _create_repositories_stats_triggers(self, cr, stats=None):
+        """(Re)create the triggers updating the repositories stats."""
+        for trigger in ("insert", "update", "delete"):
+            cr.execute(
+                f"DROP TRIGGER IF EXISTS repositories_stats_{trigger}_trigger;"
+            )
+        queries = [
             #   - after insert on modules
             f"""
-            CREATE TRIGGER IF NOT EXISTS repositories_stats_insert_trigger
+            CREATE TRIGGER repositories_stats_insert_trigger
             AFTER INSERT ON modules
             BEGIN
-                {repo_stats_trigger_query}
+                {self._repositories_stats_delta_query("NEW", "+", stats)}
             END;
             """,
             #   - after update on modules
             f"""
-            CREATE TRIGGER IF NOT EXISTS repositories_stats_update_trigger
+            CREATE TRIGGER repositories_stats_update_trigger
             AFTER UPDATE ON modules
             BEGIN
-                {repo_stats_trigger_query}
+                {self._repositories_stats_delta_query("OLD", "-", stats)}
+                {self._repositories_stats_delta_query("NEW", "+", stats)}
+            END;
+            """,
+            #   - after delete on modules
+            f"""
+            CREATE TRIGGER repositories_stats_delete_trigger
+            AFTER DELETE ON modules
+            BEGIN
+                {self._repositories_stats_delta_query("OLD", "-", stats)}
+            END;
+            """,
+        ]
+        for query in queries:
+            cr.execute(query)
+
+    def _migrate_scan_schedule(self, cr):
+        """Track the activity of repositories to schedule their scans."""
+        # Time of the last change detected on the branches of a repository,
+        # updated along with its last scanned commits. Existing repositories
+        # are considered as changed now.
+        cr.execute("ALTER TABLE repositories ADD COLUMN last_change_at REAL;")
+        cr.execute(
+            "UPDATE repositories SET last_change_at=strftime('%s', 'now');"
+        )
+        cr.execute(
+            """
+            CREATE TABLE scan_schedule (
+                repository CHAR PRIMARY KEY,
+                last_scan_at REAL,
+                next_scan_at REAL
+            );
+            """
+        )
+
+    def _migrate_scan_jobs(self, cr):
+        """Create the queue of branches to scan, fed by GitHub webhooks."""
+        cr.execute(
+            """
+            CREATE TABLE scan_jobs (
+                repository CHAR,
+                branch CHAR,
+                created_at REAL,
+                UNIQUE(repository, branch)
+            );
+            """
+        )
+
+    def _migrate_modules_status(self, cr):
+        """Store the status of modules computed from their results.
+
+        Repositories stats and reports rely on it instead of looking for
+        data in the JSON results.
+        """
+        for column in (
+            "status CHAR",
+            "nb_missing_commits INTEGER DEFAULT 0",
+            "pr_urls TEXT",
+        ):
+            cr.execute(f"ALTER TABLE modules ADD COLUMN {column};")
+        cr.execute("CREATE INDEX modules_status_index ON modules (status);")
+        rows = cr.execute(
+            "SELECT rowid, process, results FROM modules;"
+        ).fetchall()
+        cr.executemany(
+            """
+            UPDATE modules
+            SET status=?, nb_missing_commits=?, pr_urls=?
+            WHERE rowid=?;
+            """,
+            [
+                (
+                    *compute_module_status(
+                        process, json.loads(results) if results else {}
+                    ),
+                    rowid,
+                )
+                for rowid, process, results in rows
+            ],
+        )
+        self._create_repositories_stats_triggers(cr)
+        self._rebuild_repositories_stats(cr)
+
+    def _migrate_scan_generation(self, cr):
+        """Create the counter of changes made by the scanner."""
+        cr.execute("CREATE TABLE scan_generation (generation INTEGER);")
+        cr.execute("INSERT INTO scan_generation VALUES (0);")
+
+    def bump_generation(self, cr):
+        """Flag the data as changed, to be called in the transaction."""
+        cr.execute("UPDATE scan_generation SET generation=generation + 1;")
+
+    def get_generation(self):
+        """Return the number of changes made to the data so far.
+
+        Anything computed from the data remains valid as long as this
+        number does not change.
+        """
+        with self.reader() as cr:
+            cr.execute("SELECT generation FROM scan_generation;")
+            return cr.fetchone()[0]
+
+    def _migrate_versions_stats(self, cr):
+        """Summarize the stats of repositories for each pair of versions."""
+        fields = list(self._repositories_stats)
+        columns = ",\n".join(f"{field} INTEGER DEFAULT 0" for field in fields)
+        cr.execute(
+            f"""
+            CREATE TABLE versions (
+                from_version CHAR,
+                to_version CHAR,
+                {columns},
+                UNIQUE(from_version, to_version)
+            );
+            """
+        )
+        new_stats = ", ".join(f"{f}={f} + NEW.{f}" for f in fields)
+        updated_stats = ", ".join(
+            f"{f}={f} - OLD.{f} + NEW.{f}" for f in fields
+        )
+        old_stats = ", ".join(f"{f}={f} - OLD.{f}" for f in fields)
+        where = (
+            "from_version={row}.from_version AND to_version={row}.to_version"
+        )
+        queries = [
+            #   - after insert on repositories
+            f"""
+            CREATE TRIGGER versions_stats_insert_trigger
+            AFTER INSERT ON repositories
+            BEGIN
+                INSERT OR IGNORE INTO versions(from_version, to_version)
+                VALUES (NEW.from_version, NEW.to_version);
+                UPDATE versions SET {new_stats}
+                WHERE {where.format(row="NEW")};
+            END;
+            """,
+            #   - after update of stats on repositories
+            f"""
+            CREATE TRIGGER versions_stats_update_trigger
+            AFTER UPDATE OF {", ".join(fields)} ON repositories
+            BEGIN
+                UPDATE versions SET {updated_stats}
+                WHERE {where.format(row="NEW")};
+            END;
+            """,
+            #   - after delete on repositories
+            f"""
+            CREATE TRIGGER versions_stats_delete_trigger
+            AFTER DELETE ON repositories
+            BEGIN
+                UPDATE versions SET {old_stats}
+                WHERE {where.format(row="OLD")};
+            END;
+            """,
+        ]
+        for query in queries:
+            cr.execute(query)
+        self._rebuild_versions_stats(cr)
+
+    def _migrate_metrics(self, cr):
+        """Store the metrics of the scanner, to be exposed over HTTP."""
+        cr.execute(
+            """
+            CREATE TABLE metrics (
+                source CHAR PRIMARY KEY,
+                content TEXT,
+                updated_at REAL
+            );
+            """
+        )
+
+    def save_metrics(self, source, content):
+        """Save the metrics of `source`, in the Prometheus text format."""
+        with self.transaction() as cr:
+            cr.execute(
+                """
+                INSERT INTO metrics(source, content, updated_at)
+                VALUES (?, ?, strftime('%s', 'now'))
+                ON CONFLICT (source)
+                DO UPDATE SET
+                    content=excluded.content,
+                    updated_at=excluded.updated_at;
+                """,
+                (source, content),
+            )
+
+    def get_metrics(self):
+        """Return the metrics saved by all sources, as a text."""
+        with self.reader() as cr:
+            cr.execute("SELECT content FROM metrics ORDER BY source;")
+            return "".join(row[0] for row in cr.fetchall())
+
+    def _migrate_modules_report_index(self, cr):
+        """Index the modules by name and versions, to join them in reports.
+
+        It replaces the index on the name only, being a prefix of it.
+        """
+        cr.execute("DROP INDEX IF EXISTS migrations_module_index;")
+        cr.execute(
+            """
+            CREATE INDEX modules_module_versions_index
+                ON modules (module, from_version, to_version);
+            """
+        )
+
+    def _migrate_modules_search(self, cr):
+        """Index the names of modules and repositories for searches.
+
+        'module_names' lists each module of a repository once whatever
+        the pairs of versions scanned, and is indexed by trigrams in the
+        'module_names_fts' FTS5 table, both being kept in sync by triggers.
+        """
+        cr.execute(
+            """
+            CREATE TABLE module_names (
+                id INTEGER PRIMARY KEY,
+                module CHAR,
+                repository CHAR,
+                nb_versions INTEGER DEFAULT 0,
+                UNIQUE(module, repository)
+            );
+            """
+        )
+        cr.execute(
+            """
+            CREATE VIRTUAL TABLE module_names_fts USING fts5(
+                module,
+                repository,
+                content='module_names',
+                content_rowid='id',
+                tokenize='trigram'
+            );
+            """
+        )
+        where = (
+            "module={row}.module AND repository={row}.org || '/' || {row}.repo"
+        )
+        queries = [
+            #   - after insert on modules
+            """
+            CREATE TRIGGER module_names_insert_trigger
+            AFTER INSERT ON modules
+            BEGIN
+                INSERT INTO module_names(module, repository, nb_versions)
+                VALUES (NEW.module, NEW.org || '/' || NEW.repo, 1)
+                ON CONFLICT (module, repository)
+                DO UPDATE SET nb_versions=nb_versions + 1;
+            END;
+            """,
+            #   - after delete on modules
+            f"""
+            CREATE TRIGGER module_names_delete_trigger
+            AFTER DELETE ON modules
+            BEGIN
+                UPDATE module_names SET nb_versions=nb_versions - 1
+                WHERE {where.format(row="OLD")};
+                DELETE FROM module_names
+                WHERE {where.format(row="OLD")} AND nb_versions <= 0;
+            END;
+            """,
+            #   - after insert on module_names
+            """
+            CREATE TRIGGER module_names_fts_insert_trigger
+            AFTER INSERT ON module_names
+            BEGIN
+                INSERT INTO module_names_fts(rowid, module, repository)
+                VALUES (NEW.id, NEW.module, NEW.repository);
+            END;
+            """,
+            #   - after delete on module_names
+            """
+            CREATE TRIGGER module_names_fts_delete_trigger
+            AFTER DELETE ON module_names
+            BEGIN
+                INSERT INTO module_names_fts(
+                    module_names_fts, rowid, module, repository
+                ) VALUES ('delete', OLD.id, OLD.module, OLD.repository);
             END;
             """,
         ]
         for query in queries:
             cr.execute(query)
+        cr.execute(
+            """
+            INSERT INTO module_names(module, repository, nb_versions)
+            SELECT module, org || '/' || repo, COUNT(*)
+            FROM modules
+            GROUP BY module, org, repo;
+            """
+        )
+
+    def _repositories_stats_delta_query(self, row, operator, stats=None):
+        """Return a query adding/removing `row` from its repository stats.
+
+        Only the stats matching the state of the module `row` are updated,
+        instead of counting again all modules of the repository.
+        """
+        stats = stats or self._repositories_stats
+        assignments = ",\n".join(
+            f"{field}={field} {operator} "
+            f"(CASE WHEN {cond.format(m=row)} THEN 1 ELSE 0 END)"
+            for field, cond in stats.items()
+        )
+        return f"""
+            UPDATE repositories
+            SET {assignments}
+            WHERE org={row}.org
+            AND name={row}.repo
+            AND from_version={row}.from_version
+            AND to_version={row}.to_version;
+        """
+
+    def _repositories_stats_query(self, stats=None):
+        """Return a query computing repository stats from the modules."""
+        stats = stats or self._repositories_stats
+        columns = ",\n".join(
+            f"SUM(CASE WHEN {cond.format(m='m')} THEN 1 ELSE 0 END)"
+            f" AS {field}"
+            for field, cond in stats.items()
+        )
+        return f"""
+            SELECT
+                r.org,
+                r.name,
+                r.from_version,
+                r.to_version,
+                {columns}
+            FROM repositories r
+            JOIN modules m
+                ON m.org=r.org
+                AND m.repo=r.name
+                AND m.from_version=r.from_version
+                AND m.to_version=r.to_version
+            GROUP BY r.org, r.name, r.from_version, r.to_version
+        """
+
+    def check_repositories_stats(self):
+        """Return the repositories whose stats differ from their modules.
+
+        Each item is a tuple `(org, name, from_version, to_version)`.
+        """
+        fields = list(self._repositories_stats)
+        expected = {
+            row[:4]: row[4:]
+            for row in self.db.execute(self._repositories_stats_query())
+        }
+        query = f"""
+            SELECT org, name, from_version, to_version, {", ".join(fields)}
+            FROM repositories
+        """
+        invalid = []
+        for row in self.db.execute(query):
+            if row[4:] != expected.get(row[:4], (0,) * len(fields)):
+                invalid.append(row[:4])
+        return invalid
+
+    def _versions_stats_query(self):
+        """Return a query computing versions stats from the repositories."""
+        fields = list(self._repositories_stats)
+        return f"""
+            SELECT
+                from_version,
+                to_version,
+                {", ".join(f"SUM({field})" for field in fields)}
+            FROM repositories
+            GROUP BY from_version, to_version
+        """
+
+    def check_versions_stats(self):
+        """Return the pairs of versions whose stats differ from repositories.
+
+        Each item is a tuple `(from_version, to_version)`.
+        """
+        fields = list(self._repositories_stats)
+        expected = {
+            row[:2]: row[2:]
+            for row in self.db.execute(self._versions_stats_query())
+        }
+        query = f"""
+            SELECT from_version, to_version, {", ".join(fields)}
+            FROM versions
+        """
+        rows = {row[:2]: row[2:] for row in self.db.execute(query)}
+        return sorted(
+            key
+            for key in rows.keys() | expected.keys()
+            if rows.get(key) != expected.get(key)
+        )
+
+    def rebuild_repositories_stats(self):
+        """Compute again the stats of all repositories from scratch."""
+        with self.transaction() as cr:
+            self._rebuild_repositories_stats(cr)
+            self._rebuild_versions_stats(cr)
+            self.bump_generation(cr)
+
+    def _rebuild_repositories_stats(self, cr, stats=None):
+        fields = list(self._repositories_stats)
+        cr.execute(f"UPDATE repositories SET {'=0, '.join(fields)}=0;")
+        stats = cr.execute(self._repositories_stats_query(stats)).fetchall()
+        cr.executemany(
+            f"""
+            UPDATE repositories
+            SET {", ".join(f"{f}=?" for f in fields)}
+            WHERE org=? AND name=? AND from_version=? AND to_version=?;
+            """,
+            [row[4:] + row[:4] for row in stats],
+        )
+
+    def _rebuild_versions_stats(self, cr):
+        fields = list(self._repositories_stats)
+        cr.execute("DELETE FROM versions;")
+        cr.execute(
+            f"""
+            INSERT INTO versions(from_version, to_version, {", ".join(fields)})
+            {self._versions_stats_query()};
+            """
+        )
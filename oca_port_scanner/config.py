@@ -27,6 +27,12 @@ class Config(dict):
                     "options": {
                         "repositories_path": str(storage_path),
                         "database_path": str(database_path),
+                        "workers": 1,
+                        # Delays (in seconds) between two checks of the
+                        # repositories due to be scanned, and of the
+                        # branches queued by GitHub webhooks
+                        "scan_tick": 60,
+                        "jobs_tick": 5,
                     },
                     "branches_matrix": [
                         ("14.0", "15.0"),
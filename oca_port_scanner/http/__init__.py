@@ -3,22 +3,62 @@
 
 from typing import Annotated
 
+import gzip
+import hashlib
+import hmac
+import json
 import pathlib
 import re
+import time
 
-from fastapi import FastAPI, Form, Request
-from fastapi.responses import HTMLResponse, Response
+from fastapi import FastAPI, Form, HTTPException, Query, Request
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 
+from .. import metrics, snapshots
+from .cache import ResponseCache
 from .models import (
+    MODULE_FIELDS,
+    MODULES_KEY,
+    REPOSITORIES_KEY,
+    REPOSITORY_FIELDS,
+    ReportRequest,
     Repository,
+    Version,
+    backend,
+    config,
     Module,
-    get_repositories,
-    get_modules,
+    encode_cursor,
+    get_repositories_data,
+    get_modules_data,
+    get_report_data,
+    get_rows,
+    get_schedule,
     get_versions,
+    get_versions_data,
+    paginate,
+    queue_scan_job,
+    run_query,
+    search_modules,
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Responses of the API are serialized with 'orjson' if available
+APIResponse = ORJSONResponse if orjson else JSONResponse
+
 app = FastAPI()
 
 current_dir_path = pathlib.Path(__file__).parent.resolve()
@@ -29,10 +69,104 @@ app.mount(
 )
 templates = Jinja2Templates(directory=current_dir_path.joinpath("templates"))
 
+# Pages whose content only depends on the data changed by the scanner
+CACHED_PATHS = {
+    "/",
+    "/api/versions",
+    "/api/repositories",
+    "/api/modules",
+    "/api/search",
+}
+response_cache = ResponseCache(config["options"].get("http_cache_size", 256))
+# Size of the chunks sent to clients not accepting compressed snapshots
+SNAPSHOT_CHUNK_SIZE = 65536
+exports = snapshots.Snapshots(config, backend)
+
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    """Serve the cached pages while the data has not changed.
+
+    Cached pages are identified by the generation of the data as ETag, so
+    clients already having the last version get a '304 Not Modified'. Only
+    successful responses are cached, so the parameters of a request are
+    validated before it is answered with a '304'.
+    """
+    if request.method != "GET" or request.url.path not in CACHED_PATHS:
+        return await call_next(request)
+    generation = await run_query(backend.get_generation)
+    etag = f'"{generation}"'
+    params = tuple(sorted(request.query_params.multi_items()))
+    key = (request.url.path, params, generation)
+    cached = response_cache.get(key)
+    if cached is None:
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name != "content-length"
+        }
+        cached = (body, headers, response.media_type)
+        response_cache.set(key, cached)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    body, headers, media_type = cached
+    return Response(
+        body, headers=dict(headers, ETag=etag), media_type=media_type
+    )
+
+
+def _etag_matches(request, etag):
+    """Return `True` if `etag` is listed in the 'If-None-Match' header.
+
+    Entries are compared with the weak comparison of RFC 9110, as proxies
+    compressing the responses turn their ETag into a weak one.
+    """
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    return any(
+        entry.strip().removeprefix("W/") in (etag, "*")
+        for entry in header.split(",")
+    )
+
+
+REQUEST_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_http_request_seconds",
+    "Time spent handling HTTP requests, by method, path and status.",
+)
+
+
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    """Measure the time spent handling each request."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Only paths of the routes (e.g. '/api/snapshots/{from_version}/...'),
+    # to bound the number of label values
+    route = request.scope.get("route")
+    if route is not None:
+        path = route.path
+    elif request.url.path in CACHED_PATHS:
+        # Served from the cache, without reaching the router
+        path = request.url.path
+    else:
+        path = "other"
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method,
+        path=path,
+        status=response.status_code,
+    )
+    return response
+
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    versions = get_versions()
+    versions = await run_query(get_versions)
     return templates.TemplateResponse(
         "index.html",
         {
@@ -51,19 +185,44 @@ async def report(
         return HTMLResponse("Wrong 'versions' parameter", status_code=400)
     from_version, to_version = versions
     module_names = re.split(r"\W+", modules) if modules else []
-    csv_content = Module.get_csv(from_version, to_version, module_names)
+    csv_content = await run_query(
+        Module.get_csv, from_version, to_version, module_names
+    )
     headers = {
         "Content-Disposition": "attachment;filename=modules_report.csv",
     }
-    return Response(csv_content, headers=headers, media_type="text/csv")
+    return StreamingResponse(
+        csv_content, headers=headers, media_type="text/csv"
+    )
+
+
+@app.post("/api/report")
+async def api_report(report: ReportRequest):
+    """Return the migration report of modules for several pairs of versions.
+
+    The body is a JSON object listing the names of `modules` and the
+    `versions` as `[from_version, to_version]` pairs.
+    """
+    reports = await run_query(get_report_data, report.versions, report.modules)
+    return APIResponse(reports)
+
+
+@app.get("/api/versions")
+async def api_versions() -> list[Version]:
+    versions = await run_query(get_versions_data)
+    return APIResponse(versions)
 
 
 @app.get("/api/repositories")
 async def api_repositories(
+    request: Request,
     org: str = None,
     name: str = None,
     from_version: str = None,
     to_version: str = None,
+    limit: Annotated[int, Query(ge=1)] = None,
+    after: str = None,
+    fields: str = None,
 ) -> list[Repository]:
     where = []
     args = tuple()
@@ -79,17 +238,49 @@ async def api_repositories(
     if to_version:
         where.append("to_version=?")
         args += (to_version,)
-    return get_repositories(where=" AND ".join(where), args=args)
+    where, args, order_by = _paginate(
+        REPOSITORIES_KEY, " AND ".join(where), args, limit, after
+    )
+    # Rows are returned as dictionaries serialized as is, instead of being
+    # validated against the response model which is slow on large results
+    if fields:
+        fields = _get_fields(fields, REPOSITORY_FIELDS)
+        rows = await run_query(
+            get_rows,
+            "repositories",
+            fields,
+            REPOSITORIES_KEY,
+            where=where,
+            args=args,
+            order_by=order_by,
+            limit=limit and limit + 1,
+        )
+    else:
+        rows = await run_query(
+            get_repositories_data,
+            where=where,
+            args=args,
+            order_by=order_by,
+            limit=limit and limit + 1,
+        )
+    keys = [key for key, __ in rows]
+    headers = _get_page_headers(request, keys, limit)
+    return APIResponse([data for __, data in rows][:limit], headers=headers)
 
 
 @app.get("/api/modules")
 async def api_modules(
+    request: Request,
     org: str = None,
     repo: str = None,
     from_version: str = None,
     to_version: str = None,
     process: str = None,
+    status: str = None,
     existing_pr: bool = None,
+    limit: Annotated[int, Query(ge=1)] = None,
+    after: str = None,
+    fields: str = None,
 ) -> list[Module]:
     where = []
     args = tuple()
@@ -108,8 +299,214 @@ async def api_modules(
     if process:
         where.append("process=?")
         args += (process,)
-    if existing_pr:
-        where.append("existing_pr=?")
-        args += (existing_pr,)
-    modules = get_modules(where=" AND ".join(where), args=args)
-    return modules
+    if status:
+        where.append("status=?")
+        args += (status,)
+    if existing_pr is not None:
+        where.append("status=?" if existing_pr else "status!=?")
+        args += ("to review",)
+    where, args, order_by = _paginate(
+        MODULES_KEY, " AND ".join(where), args, limit, after
+    )
+    if fields:
+        fields = _get_fields(fields, MODULE_FIELDS)
+        rows = await run_query(
+            get_rows,
+            "modules",
+            fields,
+            MODULES_KEY,
+            where=where,
+            args=args,
+            order_by=order_by,
+            limit=limit and limit + 1,
+        )
+    else:
+        rows = await run_query(
+            get_modules_data,
+            where=where,
+            args=args,
+            order_by=order_by,
+            limit=limit and limit + 1,
+        )
+    keys = [key for key, __ in rows]
+    headers = _get_page_headers(request, keys, limit)
+    return APIResponse([data for __, data in rows][:limit], headers=headers)
+
+
+@app.get("/api/search")
+async def api_search(
+    q: Annotated[str, Query(min_length=1)],
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    """Search modules by their name or the name of their repository.
+
+    Names starting with `q` come first, then the most similar ones, so
+    that prefixes and misspelled names are both found.
+    """
+    results = await run_query(search_modules, q, limit)
+    return APIResponse(results)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Expose the metrics of the scanner and of the HTTP server.
+
+    Metrics are returned in the Prometheus text format.
+    """
+    scanner_metrics = await run_query(backend.get_metrics)
+    return PlainTextResponse(
+        scanner_metrics + metrics.registry.render(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/api/schedule")
+async def api_schedule():
+    schedule = await run_query(get_schedule)
+    return {
+        "queue_depth": len([s for s in schedule if s["next_scan_in"] <= 0]),
+        "repositories": schedule,
+    }
+
+
+@app.get("/api/snapshots")
+async def api_snapshots():
+    """List the snapshots of modules exported by the scanner."""
+    manifest = await run_query(exports.get_manifest)
+    if not manifest:
+        return {"generation": None, "snapshots": []}
+    return {
+        "generation": manifest["generation"],
+        "snapshots": [
+            {
+                "from_version": snapshot["from_version"],
+                "to_version": snapshot["to_version"],
+                "urls": {
+                    format_: app.url_path_for(
+                        "api_snapshot",
+                        from_version=snapshot["from_version"],
+                        to_version=snapshot["to_version"],
+                        format_=format_,
+                    )
+                    for format_ in snapshot["files"]
+                },
+            }
+            for snapshot in manifest["snapshots"]
+        ],
+    }
+
+
+@app.get("/api/snapshots/{from_version}/{to_version}.{format_}")
+async def api_snapshot(
+    request: Request, from_version: str, to_version: str, format_: str
+):
+    """Serve the snapshot of modules of a pair of versions.
+
+    Snapshots are sent as stored, compressed with gzip, to the clients
+    accepting it, and decompressed on the fly for the others. Both
+    representations have their own ETag.
+    """
+    snapshot = await run_query(
+        exports.get_file, from_version, to_version, format_
+    )
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    path, generation = snapshot
+    gzipped = _accepts_gzip(request)
+    etag = f'"{generation}-gzip"' if gzipped else f'"{generation}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    media_type = snapshots.FORMATS[format_]
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(path, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        _iter_decompressed(path), headers=headers, media_type=media_type
+    )
+
+
+def _accepts_gzip(request):
+    for encoding in request.headers.get("Accept-Encoding", "").split(","):
+        name, __, params = encoding.partition(";")
+        if name.strip() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+def _iter_decompressed(path):
+    with gzip.open(path, "rb") as file_:
+        while chunk := file_.read(SNAPSHOT_CHUNK_SIZE):
+            yield chunk
+
+
+@app.post("/webhook/github")
+async def webhook_github(request: Request):
+    """Queue the scan of branches pushed on GitHub.
+
+    The webhook has to send 'push' events with the 'application/json'
+    content type. Its signature is checked if a 'webhook_secret' is set
+    in the options.
+    """
+    body = await request.body()
+    secret = config["options"].get("webhook_secret")
+    if secret:
+        signature = "sha256=" + (
+            hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        )
+        if not hmac.compare_digest(
+            signature, request.headers.get("X-Hub-Signature-256", "")
+        ):
+            raise HTTPException(status_code=403, detail="Invalid signature")
+    if request.headers.get("X-GitHub-Event") != "push":
+        return {"queued": False}
+    try:
+        payload = json.loads(body)
+        repository = payload["repository"]["full_name"]
+        ref = payload["ref"]
+    except (ValueError, KeyError, TypeError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid payload") from exc
+    if not ref.startswith("refs/heads/"):
+        return {"queued": False}
+    branch = ref.removeprefix("refs/heads/")
+    queued = await run_query(queue_scan_job, repository, branch)
+    return {"queued": queued}
+
+
+def _paginate(key, where, args, limit, after):
+    """Return the `where`, `args` and `order_by` to get the asked page.
+
+    Pages are ordered by the unique `key` of the rows, and start after the
+    row pointed by the `after` cursor.
+    """
+    if not limit and not after:
+        return where, args, ""
+    try:
+        where, args = paginate(key, where, args, after)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return where, args, ", ".join(key)
+
+
+def _get_page_headers(request, keys, limit):
+    """Return the headers pointing to the next page, if any.
+
+    `keys` are the keys of the rows read, one more than the `limit` being
+    read to know if there is a next page.
+    """
+    if not limit or len(keys) <= limit:
+        return {}
+    cursor = encode_cursor(keys[limit - 1])
+    url = request.url.include_query_params(after=cursor)
+    return {"Link": f'<{url}>; rel="next"', "X-Next-Cursor": cursor}
+
+
+def _get_fields(fields, available_fields):
+    """Return the SQL expressions of the comma-separated `fields`."""
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in available_fields]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    return {name: available_fields[name] for name in names}
@@ -0,0 +1,41 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import collections
+
+
+class ResponseCache:
+    """Keep the last responses computed from the data of a generation.
+
+    Entries are keyed by `(path, params, generation)`, the generation being
+    bumped by the scanner each time it changes the data. At most `size`
+    responses are kept, the least recently used ones being dropped first,
+    and all of them are dropped when a new generation is seen.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.generation = None
+        self._responses = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the response cached for `key`, or `None`."""
+        response = self._responses.get(key)
+        if response is not None:
+            self._responses.move_to_end(key)
+        return response
+
+    def set(self, key, response):
+        """Cache `response` for `key`."""
+        generation = key[-1]
+        if self.generation is not None and generation < self.generation:
+            # Computed while the data was being changed: already outdated
+            return
+        if generation != self.generation:
+            # Responses of previous generations won't be used anymore
+            self._responses.clear()
+            self.generation = generation
+        self._responses[key] = response
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.size:
+            self._responses.popitem(last=False)
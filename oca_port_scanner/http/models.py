@@ -1,19 +1,85 @@
 # Copyright 2023 Camptocamp SA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
 
+import asyncio
+import base64
+import binascii
+import concurrent.futures
 import csv
+import difflib
+import functools
 import io
 import json
+import time
 
-from pydantic import BaseModel, computed_field, model_validator
+from pydantic import BaseModel, Field, computed_field
 
-from ..backend import Backend
+from ..backend import Backend, get_pr_data
 from ..config import Config
 
 config = Config()
 config.init()
 
 backend = Backend(config, check_same_thread=False)
+# Threads running the queries of the API, one per read-only connection
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=backend.readers_size, thread_name_prefix="db"
+)
+
+# Number of rows read at once when iterating on a query
+FETCH_SIZE = 1000
+# Size of the CSV chunks sent to the client when generating a report
+CSV_CHUNK_SIZE = 65536
+# Number of modules found by the full-text index, then ranked by similarity
+SEARCH_CANDIDATES = 200
+# Minimum similarity of the modules suggested for unknown ones in reports
+SUGGESTION_CUTOFF = 0.6
+# Number of modules suggested for each unknown one in reports
+SUGGESTIONS_SIZE = 3
+# Maximum number of unknown modules getting suggestions in a report, each
+# of them costing a full-text search ranking all the modules matched
+SUGGESTED_MODULES_SIZE = 20
+
+# Columns of the repositories read with their data
+REPOSITORIES_COLUMNS = (
+    "org",
+    "name",
+    "from_version",
+    "to_version",
+    "nb_modules",
+    "nb_modules_migrated",
+    "nb_modules_to_migrate",
+    "nb_modules_to_review",
+    "nb_modules_to_port_commits",
+)
+# Columns of the unique key of each table, used to paginate results
+REPOSITORIES_KEY = ("org", "name", "from_version", "to_version")
+MODULES_KEY = ("org", "repo", "module", "from_version", "to_version")
+
+# Fields that can be selected in projections, with their SQL expression
+REPOSITORY_FIELDS = {
+    "org": "org",
+    "name": "name",
+    "from_version": "from_version",
+    "to_version": "to_version",
+    "nb_modules": "nb_modules",
+    "nb_modules_migrated": "nb_modules_migrated",
+    "nb_modules_to_migrate": "nb_modules_to_migrate",
+    "nb_modules_to_review": "nb_modules_to_review",
+    "nb_modules_to_port_commits": "nb_modules_to_port_commits",
+    "fullname": "org || '/' || name",
+}
+MODULE_FIELDS = {
+    "org": "org",
+    "repo": "repo",
+    "name": "module",
+    "from_version": "from_version",
+    "to_version": "to_version",
+    "process": "process",
+    "status": "status",
+    "nb_missing_commits": "nb_missing_commits",
+    "existing_pr": "existing_pr",
+}
 
 
 class Repository(BaseModel):
@@ -32,50 +98,56 @@ class Repository(BaseModel):
         return f"{self.org}/{self.name}"
 
 
+class Version(BaseModel):
+    from_version: str
+    to_version: str
+    nb_modules: int
+    nb_modules_migrated: int
+    nb_modules_to_migrate: int
+    nb_modules_to_review: int
+    nb_modules_to_port_commits: int
+
+
 class PR(BaseModel):
+    # Fields listed in `PR_FIELDS`, read from the database by `get_pr_data`
     title: str
     number: int
     url: str
     author: str
-    merged_at: str = None
+    merged_at: str | None = None
+
+
+class ReportRequest(BaseModel):
+    modules: list[str]
+    versions: list[tuple[str, str]] = Field(min_length=1)
 
 
 class Module(BaseModel):
-    __slots__ = ("_org", "_repo", "_existing_pr_data", "_results_data")
     name: str
     from_version: str = None
     to_version: str = None
-    process: str = None
+    process: str | None = None
+    status: str | None = None
+    nb_missing_commits: int = 0
     repository: Repository = None
     existing_pr: PR = None
 
-    def __init__(self, **kwargs):
-        for field in self.__slots__:
-            object.__setattr__(self, field, kwargs.pop(field))
-        super().__init__(**kwargs)
-
-    @model_validator(mode="after")
-    def compute_fields(self) -> "Module":
-        # Use a 'model_validator' instead of a computed field as the latter
-        # can't be serialized by FastAPI
-        if self._existing_pr_data:
-            pr_data = json.loads(self._existing_pr_data)
-            self.existing_pr = PR(**pr_data)
-        if self._org and self._repo:
-            where = "org=? AND name=? AND from_version=? AND to_version=?"
-            args = (self._org, self._repo, self.from_version, self.to_version)
-            repositories = get_repositories(where=where, args=args)
-            self.repository = repositories[0]
-        return self
-
     @classmethod
     def get_csv(cls, from_version, to_version, module_names):
-        """Generate a CSV migration report of modules for given versions."""
-        where = "from_version=? AND to_version=? AND module IN (%s)" % (
-            ",".join(["?"] * len(module_names))
-        )
-        args = (from_version, to_version, *module_names)
-        modules = get_modules(where=where, args=args)
+        """Return a CSV migration report of modules for given versions.
+
+        The modules and their suggestions are read at once, so no database
+        connection is held while the report is sent to the client. The CSV
+        content is then generated by chunks by the returned iterator.
+        """
+        rows = get_report_rows([(from_version, to_version)], module_names)
+        # Modules not found, in the order they have been requested
+        unknown_modules = [row[2] for row in rows if row[3] is None]
+        suggestions = suggest_modules(unknown_modules[:SUGGESTED_MODULES_SIZE])
+        return cls._iter_csv(rows, unknown_modules, suggestions)
+
+    @classmethod
+    def _iter_csv(cls, rows, unknown_modules, suggestions):
         with io.StringIO() as file_:
             fields = [
                 "repository",
@@ -85,57 +157,399 @@ class Module(BaseModel):
             ]
             writer = csv.DictWriter(file_, fields)
             writer.writeheader()
-            for module in modules:
-                row = module._get_csv_row()
-                writer.writerow(row)
-                module_names.pop(module_names.index(module.name))
+            for __, __, module_name, repository, *data in rows:
+                if repository is None:
+                    continue
+                writer.writerow(
+                    cls._get_csv_row(repository, module_name, *data)
+                )
+                if file_.tell() >= CSV_CHUNK_SIZE:
+                    yield cls._flush_csv(file_)
             # Append remaining modules that haven't been recognized
-            if module_names:
+            if unknown_modules:
                 writer.writerow({})
                 writer.writerow({"repository": "UNKNOWN"})
-            for module_name in module_names:
+            for module_name in unknown_modules:
                 row = {
                     "repository": "",
                     "module": module_name,
                     "status": "migrate",
                 }
+                if suggestions.get(module_name):
+                    row["info"] = "Did you mean: {}?".format(
+                        ", ".join(suggestions[module_name])
+                    )
                 writer.writerow(row)
-            file_.seek(0)
-            content = file_.read()
+                if file_.tell() >= CSV_CHUNK_SIZE:
+                    yield cls._flush_csv(file_)
+            yield cls._flush_csv(file_)
+
+    @staticmethod
+    def _flush_csv(file_):
+        """Return the content of `file_` and empty it."""
+        content = file_.getvalue()
+        file_.seek(0)
+        file_.truncate()
         return content
 
-    def _get_csv_row(self):
+    @staticmethod
+    def _get_csv_row(repository, module, status, nb_missing_commits, pr_urls):
         row = {
-            "repository": self.repository.fullname,
-            "module": self.name,
-            "status": self.process,
+            "repository": repository,
+            "module": module,
+            "status": status,
         }
-        if not self.process:
-            row["status"] = "available"
-        elif self.process == "port_commits":
-            results = (
-                json.loads(self._results_data) if self._results_data else {}
-            )
-            commits = [pr["missing_commits"] for pr in results.values()]
-            nb_commits = len(commits)
-            info = f"{nb_commits} commits to check/port from:"
-            info = "\n".join(
-                [info] + [f"- {pr['url']}" for pr in results.values()]
-            )
-            row["info"] = info
-        if self.existing_pr:
-            row["status"] = "to review"
-            row["info"] = self.existing_pr.url
+        if status == "port_commits":
+            info = f"{nb_missing_commits} commits to check/port from:"
+            urls = pr_urls.split("\n") if pr_urls else []
+            row["info"] = "\n".join([info] + [f"- {url}" for url in urls])
+        elif status == "to review":
+            row["info"] = pr_urls
         return row
 
 
-def get_repositories(where="", args=tuple()):
-    con = backend.db
-    cr = con.cursor()
+async def run_query(func, *args, **kwargs):
+    """Run `func` querying the database without blocking the event loop.
+
+    `func` is run by the threads of `executor`, so requests waiting for the
+    database do not delay the other ones.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def get_repositories_data(where="", args=tuple(), order_by="", limit=None):
+    """Return the repositories matching `where` as `(key, data)` tuples.
+
+    `data` is a dictionary serialized like the `Repository` model, but
+    built without validating it, which is much faster for large results.
+    """
+    query = f"SELECT {', '.join(REPOSITORIES_COLUMNS)} FROM repositories"
+    query = _complete_query(query, where, order_by, limit)
+    with backend.reader() as cr:
+        cr.execute(query, args)
+        rows = cr.fetchall()
+    return [(row[:4], _get_repository_data(row)) for row in rows]
+
+
+def _read_repositories_data(cr, keys):
+    """Return the data of the repositories of `keys` read with `cr`.
+
+    Return a dictionary `{key: data}`, `data` being serialized like the
+    `Repository` model.
+    """
+    columns = ", ".join(f"r.{column}" for column in REPOSITORIES_COLUMNS)
+    values = ", ".join(["(?, ?, ?, ?)"] * len(keys))
+    query = f"""
+        SELECT {columns}
+        FROM (VALUES {values}) AS k
+        JOIN repositories AS r
+            ON r.org=k.column1
+            AND r.name=k.column2
+            AND r.from_version=k.column3
+            AND r.to_version=k.column4;
+    """
+    cr.execute(query, [value for key in keys for value in key])
+    return {row[:4]: _get_repository_data(row) for row in cr.fetchall()}
+
+
+def _get_repository_data(row):
+    return {
+        "org": row[0],
+        "name": row[1],
+        "from_version": row[2],
+        "to_version": row[3],
+        "nb_modules": row[4],
+        "nb_modules_migrated": row[5],
+        "nb_modules_to_migrate": row[6],
+        "nb_modules_to_review": row[7],
+        "nb_modules_to_port_commits": row[8],
+        "fullname": f"{row[0]}/{row[1]}",
+    }
+
+
+def get_modules_data(where="", args=tuple(), order_by="", limit=None):
+    return list(iter_modules_data(where, args, order_by, limit))
+
+
+def iter_modules_data(where="", args=tuple(), order_by="", limit=None):
+    """Yield the modules matching `where` as `(key, data)` tuples.
+
+    `data` is a dictionary serialized like the `Module` model, but built
+    without validating it, which is much faster for large results.
+    """
     query = """
         SELECT
             org,
-            name,
+            repo,
+            module,
+            from_version,
+            to_version,
+            process,
+            status,
+            nb_missing_commits,
+            existing_pr
+        FROM modules
+    """
+    query = _complete_query(query, where, order_by, limit)
+    # Repositories of the modules read, loaded once per chunk of rows with
+    # the same connection instead of querying them for each module
+    repositories = {}
+    with backend.reader() as cr:
+        cr.execute(query, args)
+        while rows := cr.fetchmany(FETCH_SIZE):
+            keys = {(row[0], row[1], row[3], row[4]) for row in rows}
+            keys -= repositories.keys()
+            if keys:
+                repositories.update(
+                    _read_repositories_data(cr.connection.cursor(), keys)
+                )
+            for row in rows:
+                yield row[:5], {
+                    "name": row[2],
+                    "from_version": row[3],
+                    "to_version": row[4],
+                    "process": row[5],
+                    "status": row[6],
+                    "nb_missing_commits": row[7],
+                    "repository": repositories.get(
+                        (row[0], row[1], row[3], row[4])
+                    ),
+                    "existing_pr": get_pr_data(row[8]),
+                }
+
+
+def get_report_rows(version_pairs, module_names):
+    """Return the rows of a migration report of modules for pairs of versions.
+
+    Rows are tuples `(from_version, to_version, module, repository, status,
+    nb_missing_commits, pr_urls)` ordered by pairs of versions then by
+    modules as requested, `repository` being `None` for unknown modules.
+    Requested values are loaded in temporary tables to resolve the whole
+    report with a single join, whatever the number of modules. Rows are
+    all fetched (one per requested module and pair) before returning, to
+    release the connection and end its read transaction.
+    """
+    # Without statistics on the temporary tables, SQLite prefers to build
+    # an automatic index on 'modules' for each query (full scan)
+    query = """
+        SELECT
+            v.from_version,
+            v.to_version,
+            r.module,
+            m.org || '/' || m.repo,
+            m.status,
+            m.nb_missing_commits,
+            m.pr_urls
+        FROM report_versions AS v
+        CROSS JOIN report_modules AS r
+        LEFT JOIN modules AS m INDEXED BY modules_module_versions_index
+            ON m.module=r.module
+            AND m.from_version=v.from_version
+            AND m.to_version=v.to_version
+        ORDER BY v.position, r.position
+    """
+    version_pairs = dict.fromkeys(tuple(pair) for pair in version_pairs)
+    module_names = dict.fromkeys(module_names)
+    with backend.reader() as cr:
+        with backend.temp_table(
+            cr,
+            "report_versions",
+            ["position INTEGER PRIMARY KEY", "from_version", "to_version"],
+            [(None, *pair) for pair in version_pairs],
+        ):
+            with backend.temp_table(
+                cr,
+                "report_modules",
+                ["position INTEGER PRIMARY KEY", "module"],
+                [(None, name) for name in module_names],
+            ):
+                cr.execute(query)
+                rows = cr.fetchall()
+    return rows
+
+
+def get_report_data(version_pairs, module_names):
+    """Return a migration report of modules for each pair of versions.
+
+    Each item is a dictionary with the modules found for a pair of versions
+    and the names of the modules unknown for this pair.
+    """
+    reports = {}
+    for pair in version_pairs:
+        reports[tuple(pair)] = {
+            "from_version": pair[0],
+            "to_version": pair[1],
+            "modules": [],
+            "unknown_modules": [],
+        }
+    for row in get_report_rows(version_pairs, module_names):
+        report = reports[row[:2]]
+        if row[3] is None:
+            report["unknown_modules"].append(row[2])
+            continue
+        report["modules"].append(
+            {
+                "repository": row[3],
+                "name": row[2],
+                "status": row[4],
+                "nb_missing_commits": row[5],
+                "pr_urls": row[6].split("\n") if row[6] else [],
+            }
+        )
+    return list(reports.values())
+
+
+def search_modules(query, limit=20):
+    """Return the modules whose name or repository name match `query`.
+
+    Candidates are the modules whose name starts with `query`, and those
+    sharing trigrams with it found with the full-text index, ranked by
+    similarity, the former coming first.
+    Each item is a dictionary with the `name` and `repository` of a module
+    and its similarity `score` (from 0 to 1).
+    """
+    query = query.strip().lower()
+    if not query:
+        return []
+    with backend.reader() as cr:
+        cr.execute(
+            """
+            SELECT module, repository
+            FROM module_names
+            WHERE module >= ? AND module < ?
+            ORDER BY module
+            LIMIT ?;
+            """,
+            (query, query + "\uffff", SEARCH_CANDIDATES),
+        )
+        rows = cr.fetchall()
+        match = _get_trigrams_match(query)
+        if match:
+            # Modules sharing any trigram, the most relevant ones first
+            cr.execute(
+                """
+                SELECT module, repository
+                FROM module_names_fts
+                WHERE module_names_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?;
+                """,
+                (match, SEARCH_CANDIDATES),
+            )
+            rows += cr.fetchall()
+    results = []
+    for module, repository in dict.fromkeys(rows):
+        repository_name = repository.split("/", maxsplit=1)[-1]
+        score = max(
+            difflib.SequenceMatcher(None, query, module).ratio(),
+            difflib.SequenceMatcher(None, query, repository_name).ratio(),
+        )
+        results.append(
+            {"name": module, "repository": repository, "score": score}
+        )
+    results.sort(
+        key=lambda item: (
+            not item["name"].startswith(query),
+            -item["score"],
+            item["name"],
+            item["repository"],
+        )
+    )
+    return results[:limit]
+
+
+def suggest_modules(module_names):
+    """Return the names of existing modules close to each of `module_names`.
+
+    Return a dictionary `{module_name: suggestions}`. Candidates are the
+    modules whose name starts with the requested one and those sharing
+    the most trigrams with it, or for names too short to have trigrams,
+    the modules whose name is short enough to be similar. All names are
+    looked up with the same connection.
+    """
+    queries = {name: name.strip().lower() for name in module_names}
+    candidates = {name: set() for name in queries}
+    with backend.reader() as cr:
+        for name, query in queries.items():
+            if not query:
+                continue
+            cr.execute(
+                """
+                SELECT DISTINCT module
+                FROM module_names
+                WHERE module >= ? AND module < ?
+                ORDER BY module
+                LIMIT ?;
+                """,
+                (query, query + "\uffff", SEARCH_CANDIDATES),
+            )
+            candidates[name].update(row[0] for row in cr.fetchall())
+            match = _get_trigrams_match(query, column="module")
+            if match:
+                cr.execute(
+                    """
+                    SELECT module
+                    FROM module_names_fts
+                    WHERE module_names_fts MATCH ?
+                    ORDER BY rank
+                    LIMIT ?;
+                    """,
+                    (match, SEARCH_CANDIDATES),
+                )
+                candidates[name].update(row[0] for row in cr.fetchall())
+        short_names = [
+            name for name, query in queries.items() if 0 < len(query) < 3
+        ]
+        if short_names:
+            # The similarity of two names is at most twice the length of
+            # the shortest one divided by the sum of their lengths
+            length = max(len(queries[name]) for name in short_names)
+            max_length = int(
+                length * (2 - SUGGESTION_CUTOFF) / SUGGESTION_CUTOFF
+            )
+            cr.execute(
+                """
+                SELECT DISTINCT module
+                FROM module_names
+                WHERE length(module) <= ?;
+                """,
+                (max_length,),
+            )
+            short_modules = {row[0] for row in cr.fetchall()}
+            for name in short_names:
+                candidates[name].update(short_modules)
+    return {
+        name: difflib.get_close_matches(
+            name, sorted(candidates[name]), SUGGESTIONS_SIZE, SUGGESTION_CUTOFF
+        )
+        for name in queries
+    }
+
+
+def get_versions():
+    """Return the pairs of versions having modules."""
+    query = """
+        SELECT from_version, to_version
+        FROM versions
+        WHERE nb_modules > 0
+        ORDER BY from_version, to_version
+    """
+    with backend.reader() as cr:
+        cr.execute(query)
+        rows = cr.fetchall()
+    return rows
+
+
+def get_versions_data():
+    """Return the pairs of versions having modules, with their stats.
+
+    Each item is a dictionary serialized like the `Version` model.
+    """
+    query = """
+        SELECT
             from_version,
             to_version,
             nb_modules,
@@ -143,68 +557,148 @@ def get_repositories(where="", args=tuple()):
             nb_modules_to_migrate,
             nb_modules_to_review,
             nb_modules_to_port_commits
-        FROM repositories
+        FROM versions
+        WHERE nb_modules > 0
+        ORDER BY from_version, to_version
     """
-    if where:
-        query = f"{query} WHERE {where}"
-    cr.execute(query, args)
-    rows = cr.fetchall()
-    repositories = []
-    for row in rows:
-        repo = Repository(
-            org=row[0],
-            name=row[1],
-            from_version=row[2],
-            to_version=row[3],
-            nb_modules=row[4],
-            nb_modules_migrated=row[5],
-            nb_modules_to_migrate=row[6],
-            nb_modules_to_review=row[7],
-            nb_modules_to_port_commits=row[8],
+    with backend.reader() as cr:
+        cr.execute(query)
+        rows = cr.fetchall()
+    fields = list(Version.model_fields)
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def get_schedule():
+    """Return the scan schedule of the configured repositories.
+
+    Repositories are sorted by their next scan, `next_scan_in` being the
+    number of seconds before it (zero or less when the scan is due).
+    """
+    query = "SELECT repository, last_scan_at, next_scan_at FROM scan_schedule"
+    with backend.reader() as cr:
+        cr.execute(query)
+        rows = {row[0]: row[1:] for row in cr.fetchall()}
+    now = time.time()
+    schedule = []
+    for repository in config["repositories"]:
+        last_scan_at, next_scan_at = rows.get(repository, (None, None))
+        schedule.append(
+            {
+                "repository": repository,
+                "last_scan_at": last_scan_at,
+                "next_scan_at": next_scan_at,
+                "next_scan_in": next_scan_at - now if next_scan_at else 0,
+            }
         )
-        repositories.append(repo)
-    return repositories
+    schedule.sort(key=lambda item: item["next_scan_at"] or 0)
+    return schedule
+
 
+def queue_scan_job(repository, branch):
+    """Queue the scan of `branch` of `repository`, if configured.
 
-def get_modules(where="", args=tuple()):
-    con = backend.db
-    cr = con.cursor()
+    Return `True` if the job has been queued. A branch already queued is
+    queued again, to be scanned once more if its scan is running.
+    """
+    branches = {
+        branch for pair in config["branches_matrix"] for branch in pair
+    }
+    if repository not in config["repositories"] or branch not in branches:
+        return False
     query = """
-        SELECT
-            org,
-            repo,
-            module,
-            from_version,
-            to_version,
-            process,
-            existing_pr,
-            results
-        FROM modules
+        INSERT INTO scan_jobs(repository, branch, created_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (repository, branch)
+        DO UPDATE SET created_at=excluded.created_at;
+    """
+    with backend.transaction() as cr:
+        cr.execute(query, (repository, branch, time.time()))
+    return True
+
+
+def get_rows(
+    table, fields, key=(), where="", args=tuple(), order_by="", limit=None
+):
+    """Return rows of `table` as dictionaries of the selected `fields`.
+
+    `fields` maps the returned fields to their SQL expression. This is a
+    lighter alternative to the models when only some fields are needed.
+    Each row is returned as a `(key, data)` tuple, `key` being the values
+    of the `key` columns.
     """
+    columns = ", ".join([*key, *fields.values()])
+    query = _complete_query(
+        f"SELECT {columns} FROM {table}", where, order_by, limit
+    )
+    with backend.reader() as cr:
+        cr.execute(query, args)
+        rows = cr.fetchall()
+    items = []
+    size = len(key)
+    for row in rows:
+        data = dict(zip(fields, row[size:]))
+        if "existing_pr" in data:
+            data["existing_pr"] = get_pr_data(data["existing_pr"])
+        items.append((row[:size], data))
+    return items
+
+
+def _get_trigrams_match(query, column=None):
+    """Return a full-text query matching any trigram of `query`, if any."""
+    trigrams = dict.fromkeys(map("".join, zip(query, query[1:], query[2:])))
+    if not trigrams:
+        return None
+    match = " OR ".join(
+        '"{}"'.format(trigram.replace('"', '""')) for trigram in trigrams
+    )
+    if column:
+        match = f"{column} : ({match})"
+    return match
+
+
+def _complete_query(query, where="", order_by="", limit=None):
     if where:
         query = f"{query} WHERE {where}"
-    cr.execute(query, args)
-    rows = cr.fetchall()
-    modules = []
-    for row in rows:
-        module = Module(
-            _org=row[0],
-            _repo=row[1],
-            name=row[2],
-            from_version=row[3],
-            to_version=row[4],
-            process=row[5],
-            _existing_pr_data=row[6],
-            _results_data=row[7],
-        )
-        modules.append(module)
-    return modules
+    if order_by:
+        query = f"{query} ORDER BY {order_by}"
+    if limit is not None:
+        query = f"{query} LIMIT {int(limit)}"
+    return query
 
 
-def get_versions():
-    con = backend.db
-    cr = con.cursor()
-    query = "SELECT DISTINCT from_version, to_version FROM modules"
-    cr.execute(query)
-    rows = cr.fetchall()
-    return rows
+def encode_cursor(values):
+    """Return an opaque cursor pointing after the row key `values`."""
+    data = json.dumps(list(values)).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor, key):
+    """Return the row key values of `cursor` for the `key` columns.
+
+    Raise a `ValueError` if the cursor is invalid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+    if not isinstance(values, list) or len(values) != len(key):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    # Values are bound as parameters of the query: only scalars are valid
+    for value in values:
+        if value is not None and type(value) not in (str, int):
+            raise ValueError(f"Invalid cursor {cursor!r}")
+    return values
+
+
+def paginate(key, where="", args=tuple(), after=None):
+    """Return `where` and `args` restricted to rows located after `after`.
+
+    Rows are ordered by their unique `key`, so the condition can be
+    resolved by its index whatever the page.
+    """
+    if not after:
+        return where, args
+    values = decode_cursor(after, key)
+    condition = f"({', '.join(key)}) > ({', '.join('?' * len(key))})"
+    where = f"({where}) AND {condition}" if where else condition
+    return where, (*args, *values)
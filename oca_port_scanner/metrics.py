@@ -0,0 +1,159 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import contextlib
+import math
+import threading
+import time
+
+# Upper bounds of the histogram buckets (in seconds), from the sub-second
+# SQLite writes to the oca-port analyses and fetches of large repositories
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    math.inf,
+)
+
+
+class Metric:
+    """Metric whose values are tracked for each combination of labels."""
+
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            samples = list(self._samples())
+        for name, labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def _get_key(labels):
+        return tuple(sorted(labels.items()))
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set_total(self, value, **labels):
+        """Set the total of a counter maintained elsewhere."""
+        with self._lock:
+            self._values[self._get_key(labels)] = value
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            # Count of each bucket, sum and count of the observed values
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = "+Inf" if bound == math.inf else str(bound)
+                yield f"{self.name}_bucket", key + (("le", le),), bucket_count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+
+class Registry:
+    """Collection of the metrics of a process."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, description):
+        return self._register(Counter, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, description, buckets)
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(f"{metric.render()}\n" for metric in metrics)
+
+    def _register(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return f"{{{values}}}"
+
+
+# Metrics of the current process
+registry = Registry()
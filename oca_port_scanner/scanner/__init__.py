@@ -1,9 +1,40 @@
+import logging
+
+from .. import backend, config
 from . import app
 
+logger = logging.getLogger(__name__)
+
 
 def main():
     app.App().run()
 
 
+def rebuild_stats():
+    """Check and rebuild the repositories and versions stats."""
+    config_ = config.Config()
+    config_.init()
+    backend_ = backend.Backend(config_)
+    for (
+        org,
+        name,
+        from_version,
+        to_version,
+    ) in backend_.check_repositories_stats():
+        logger.warning(
+            "%s/%s: inconsistent stats (%s -> %s)",
+            org,
+            name,
+            from_version,
+            to_version,
+        )
+    for from_version, to_version in backend_.check_versions_stats():
+        logger.warning(
+            "%s -> %s: inconsistent stats", from_version, to_version
+        )
+    backend_.rebuild_repositories_stats()
+    logger.info("Repository stats rebuilt")
+
+
 if __name__ == "__main__":
     main()
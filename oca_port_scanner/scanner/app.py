@@ -1,19 +1,54 @@
 # Copyright 2023 Camptocamp SA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
 
+import collections
+import concurrent.futures
+import contextlib
 import logging
+import multiprocessing
+import os
+import pathlib
 import signal
 import sys
+import threading
 import time
 
 import schedule
 
-from .. import backend, config, storage
-from .repo import Repo
+from .. import backend, config, metrics, snapshots, storage
+from . import github
+from .repo import GitRepoCache, Repo, init_analysis_worker
+from .scheduler import Scheduler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CYCLE_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_cycle_seconds",
+    "Time spent scanning the repositories due.",
+)
+SCANS = metrics.registry.counter(
+    "oca_port_scanner_scans_total",
+    "Scans of repositories, by trigger ('schedule' or 'webhook') and"
+    " result ('done' or 'failed').",
+)
+SCAN_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_scan_seconds",
+    "Time spent scanning a fetched repository.",
+)
+GITHUB_REQUESTS = metrics.registry.counter(
+    "oca_port_scanner_github_requests_total",
+    "Requests sent to GitHub API, by resource.",
+)
+GITHUB_THROTTLED_SECONDS = metrics.registry.counter(
+    "oca_port_scanner_github_throttled_seconds_total",
+    "Time spent waiting for the rate limits of GitHub API, by resource.",
+)
+SNAPSHOTS_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_snapshots_export_seconds",
+    "Time spent exporting the snapshots of modules.",
+)
+
 
 class SignalHandler:
     def __init__(self):
@@ -40,28 +75,281 @@ class App:
         self.config = config.Config()
         self.config.init()
         self.storage = storage.Storage(self.config)
-        self.backend = backend.Backend(self.config)
+        # The database connection is shared by the scanning threads, the
+        # backend serializing the writes on it
+        self.backend = backend.Backend(self.config, check_same_thread=False)
         self.repositories = self.config["repositories"]
+        self.workers = self.config["options"].get("workers", 1)
+        self.analysis_workers = self.config["options"].get(
+            "analysis_workers", 1
+        )
+        self._init_analysis_pool()
+        self.git_repos = GitRepoCache(
+            self.config["options"].get("git_cache_size", self.workers)
+        )
         self.branches_matrix = [
             (k, v) for k, v in self.config["branches_matrix"]
         ]
         self.branches = sorted(set(sum(self.branches_matrix, ())))
-        # FIXME test
-        # schedule.every().hour.do(self._scan_repositories)
-        schedule.every(2).seconds.do(self._scan_repositories)
+        self.scheduler = Scheduler(self)
+        self.snapshots = snapshots.Snapshots(self.config, self.backend)
+        # Check regularly the repositories due to be scanned. Jobs are run
+        # synchronously, so a cycle never overlaps the previous one.
+        schedule.every(self.config["options"].get("scan_tick", 60)).seconds.do(
+            self._scan_repositories
+        )
+        # Scan the branches queued by GitHub webhooks soon after their push,
+        # in a thread not waiting for the end of the running cycle
+        self.jobs_tick = self.config["options"].get("jobs_tick", 5)
+        self._jobs_thread = threading.Thread(
+            target=self._run_scan_jobs_loop, name="jobs"
+        )
+        self._stopping = threading.Event()
+        # Locks of the repositories being scanned, by the cycles or the jobs
+        self._repository_locks = {}
+        self._snapshots_lock = threading.Lock()
+
+    def _init_analysis_pool(self):
+        """Initialize the pool of processes running oca-port analyses.
+
+        The requests sent by oca-port to GitHub API are throttled by a rate
+        limiter, shared by all processes through a manager if any.
+        """
+        budgets = self.config["options"].get("github_rate_limits")
+        self._manager = self.analysis_pool = None
+        self._analysis_pool_lock = threading.Lock()
+        if self.analysis_workers > 1:
+            # Do not fork the threads and connections of the scanner
+            self._mp_context = multiprocessing.get_context("spawn")
+            self._manager = github.Manager(ctx=self._mp_context)
+            self._manager.start()
+            self.rate_limiter = self._manager.RateLimiter(budgets)
+            self.analysis_pool = self._create_analysis_pool()
+        else:
+            self.rate_limiter = github.RateLimiter(budgets)
+        github.install(self.rate_limiter)
+
+    def _create_analysis_pool(self):
+        """Return a new pool of processes running oca-port analyses."""
+        # Numbers of the oca-port cache folders of the processes
+        slots = self._mp_context.Queue()
+        for slot in range(self.analysis_workers):
+            slots.put(slot)
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.analysis_workers,
+            mp_context=self._mp_context,
+            initializer=init_analysis_worker,
+            initargs=(self.rate_limiter, slots, self._get_cache_path()),
+        )
+
+    def restart_analysis_pool(self, pool):
+        """Replace the analysis `pool`, broken by the death of a process.
+
+        A pool whose process died (e.g. killed by the OOM killer) refuses
+        any new analysis. The scans using `pool` fail, and only the first
+        of them replaces it: the next ones use the new pool.
+        """
+        with self._analysis_pool_lock:
+            if self.analysis_pool is not pool:
+                return
+            logger.warning("Analysis pool broken, restart it")
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.analysis_pool = self._create_analysis_pool()
+
+    def _get_cache_path(self):
+        """Return the folder of the oca-port caches of the analysis pool."""
+        cache_path = self.config["options"].get("analysis_cache_path")
+        if cache_path:
+            return pathlib.Path(cache_path)
+        default_cache_path = pathlib.Path.home().joinpath(".cache")
+        return pathlib.Path(
+            os.environ.get("XDG_CACHE_HOME", default_cache_path),
+            "oca-port-scanner",
+        )
 
     def _scan_repositories(self):
-        """Scan repositories for all branch combinations provided."""
-        logger.info("Scan %s repositories...", len(self.repositories))
-        for repository in self.repositories:
-            repo = Repo(self, repository)
-            repo.fetch()
-            repo.scan()
+        """Scan the repositories due for all branch combinations provided."""
+        repositories = self.scheduler.get_due_repositories()
+        if not repositories:
+            return
+        logger.info(
+            "Scan %s/%s repositories (%s workers)...",
+            len(repositories),
+            len(self.repositories),
+            self.workers,
+        )
+        with CYCLE_SECONDS.time(), self._get_executor("scan") as executor:
+            futures = {
+                executor.submit(self._scan_repository, repository): repository
+                for repository in repositories
+            }
+            cache_stats = collections.Counter()
+            for future in concurrent.futures.as_completed(futures):
+                repository = futures[future]
+                try:
+                    cache_stats.update(future.result())
+                except Exception:
+                    logger.exception("%s: scan failed", repository)
+                    SCANS.inc(trigger="schedule", result="failed")
+                else:
+                    SCANS.inc(trigger="schedule", result="done")
+                # Failed scans are rescheduled too, to not retry them
+                # in a loop
+                self.scheduler.reschedule(repository)
+        nb_analyses = cache_stats.total()
+        logger.info(
+            "oca-port cache: %s hits, %s misses (%.0f%% hit ratio)",
+            cache_stats["hits"],
+            cache_stats["misses"],
+            100 * cache_stats["hits"] / nb_analyses if nb_analyses else 0,
+        )
+        for resource, stats in self.rate_limiter.metrics().items():
+            logger.info(
+                "GitHub '%s': %s requests, %.1fs waited",
+                resource,
+                stats["tokens_spent"],
+                stats["time_waited"],
+            )
+        # Queue depth: repositories that became due during the cycle
+        now = time.time()
+        queue = self.scheduler.get_queue()
+        logger.info(
+            "%s repositories due, next scan in %.0fs",
+            len([repo for repo, next_at in queue if next_at <= now]),
+            max(queue[0][1] - now, 0) if queue else 0,
+        )
+        self._export_snapshots()
+        self._save_metrics()
+
+    def _run_scan_jobs_loop(self):
+        """Run the scan jobs regularly, until the scanner is stopped."""
+        while not self._stopping.wait(self.jobs_tick):
+            try:
+                self._run_scan_jobs()
+            except Exception:
+                logger.exception("Scan jobs failed")
+
+    def _run_scan_jobs(self):
+        """Scan the branches queued by GitHub webhooks.
+
+        Only the pushed branches are fetched, and only the combinations of
+        branches involving them are scanned. Jobs not run yet when the
+        scanner is stopped stay queued.
+        """
+        jobs = self.scheduler.get_jobs()
+        if not jobs:
+            return
+        logger.info("Run scan jobs of %s repositories...", len(jobs))
+        with self._get_executor("job") as executor:
+            futures = {
+                executor.submit(
+                    self._scan_repository, repository, sorted(branches)
+                ): repository
+                for repository, branches in jobs.items()
+                if repository in self.repositories
+            }
+            for future in concurrent.futures.as_completed(futures):
+                if self._stopping.is_set():
+                    for future_ in futures:
+                        future_.cancel()
+                    return
+                repository = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("%s: scan job failed", repository)
+                    SCANS.inc(trigger="webhook", result="failed")
+                else:
+                    SCANS.inc(trigger="webhook", result="done")
+                    # Just scanned: postpone its regular scan
+                    self.scheduler.reschedule(repository)
+        # Failed jobs are removed too, the regular scans catching up later
+        self.scheduler.remove_jobs(jobs)
+        self._export_snapshots()
+        self._save_metrics()
+
+    @contextlib.contextmanager
+    def _get_executor(self, thread_name_prefix):
+        """Return a pool of threads scanning repositories.
+
+        If the block is interrupted (e.g. the scanner is stopped by a
+        signal), the scans not started yet are cancelled instead of being
+        waited for, only the running ones being completed.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=thread_name_prefix
+        )
+        try:
+            yield executor
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    def _export_snapshots(self):
+        """Export the snapshots of modules if the data has changed."""
+        start = time.perf_counter()
+        try:
+            with self._snapshots_lock:
+                exported = self.snapshots.export()
+        except Exception:
+            # Served snapshots are kept as is, until the next cycle
+            logger.exception("Snapshots export failed")
+            return
+        if exported:
+            duration = time.perf_counter() - start
+            SNAPSHOTS_SECONDS.observe(duration)
+            logger.info("Snapshots exported in %.1fs", duration)
+
+    def _save_metrics(self):
+        """Save the metrics of the scanner, exposed by the HTTP server."""
+        for resource, stats in self.rate_limiter.metrics().items():
+            GITHUB_REQUESTS.set_total(stats["tokens_spent"], resource=resource)
+            GITHUB_THROTTLED_SECONDS.set_total(
+                stats["time_waited"], resource=resource
+            )
+        self.backend.save_metrics("scanner", metrics.registry.render())
+
+    def _scan_repository(self, repository, branches=None):
+        """Fetch and scan one repository, or only some of its `branches`.
+
+        A repository is scanned by one thread at a time, the scan jobs
+        running while the cycles are in progress.
+        Return the hits and misses of the oca-port results cache.
+        """
+        repo = Repo(self, repository)
+        lock = self._repository_locks.setdefault(repository, threading.Lock())
+        with lock:
+            start = time.perf_counter()
+            try:
+                repo.fetch(branches)
+                fetched = time.perf_counter()
+                repo.scan(branches)
+                scanned = time.perf_counter()
+            finally:
+                repo.close()
+        SCAN_SECONDS.observe(scanned - fetched)
+        logger.info(
+            "%s: fetched in %.1fs, scanned in %.1fs",
+            repository,
+            fetched - start,
+            scanned - fetched,
+        )
+        return repo.cache_stats
 
     def run(self):
         logger.info("Started")
         SignalHandler()
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self._jobs_thread.start()
+        try:
+            while True:
+                schedule.run_pending()
+                time.sleep(1)
+        finally:
+            self._stopping.set()
+            self._jobs_thread.join()
+            self.git_repos.clear()
+            if self.analysis_pool:
+                self.analysis_pool.shutdown(cancel_futures=True)
+                self._manager.shutdown()
         logger.info("Stopped")
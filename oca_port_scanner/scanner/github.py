@@ -0,0 +1,166 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import logging
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import requests
+from oca_port.utils import github as oca_port_github
+
+logger = logging.getLogger(__name__)
+
+# Default budgets of requests per resource, as `(requests, period)` where
+# `period` is expressed in seconds (limits of an authenticated user)
+DEFAULT_BUDGETS = {
+    "core": (5000, 3600),
+    "search": (30, 60),
+}
+
+
+class TokenBucket:
+    """Token bucket spending at most `budget` tokens per `period` seconds.
+
+    The bucket is synchronized with the rate limit headers returned by
+    GitHub, so it only throttles requests when the budget is running low.
+    """
+
+    def __init__(self, budget, period):
+        self.budget = budget
+        self.rate = budget / period
+        self.tokens = float(budget)
+        self.reset_at = None
+        self.tokens_spent = 0
+        self.time_waited = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one to be available if needed."""
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            self.tokens_spent += 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            if self.reset_at and self.tokens < 1:
+                # Quota exhausted on GitHub side: wait for its reset
+                delay = max(delay, self.reset_at - time.time())
+            self.time_waited += delay
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def update(self, remaining, reset_at):
+        """Synchronize the bucket with the quota reported by GitHub."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+            self.reset_at = reset_at
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.reset_at and time.time() >= self.reset_at:
+            # GitHub has reset the quota
+            self.tokens = float(self.budget)
+            self.reset_at = None
+        elif not self.reset_at:
+            # Until its reset, GitHub does not refill the quota: tokens stay
+            # capped to the remaining requests it reported
+            elapsed = now - self._updated_at
+            self.tokens = min(self.budget, self.tokens + elapsed * self.rate)
+        self._updated_at = now
+
+
+class RateLimiter:
+    """Schedule requests to GitHub API according to its rate limits.
+
+    GitHub applies distinct limits to each kind of resource ('core',
+    'search'...), each of them is throttled by its own token bucket.
+    """
+
+    def __init__(self, budgets=None):
+        budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.buckets = {
+            resource: TokenBucket(budget, period)
+            for resource, (budget, period) in budgets.items()
+        }
+
+    def acquire(self, url):
+        """Wait until a request to `url` can be sent."""
+        resource = self._get_resource(url)
+        delay = self.buckets[resource].acquire()
+        if delay > 0:
+            logger.info("GitHub '%s' throttled for %.1fs", resource, delay)
+
+    def update(self, url, headers):
+        """Update the rate limit of `url` from the headers of a response."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is None:
+            return
+        resource = headers.get("X-RateLimit-Resource")
+        if resource not in self.buckets:
+            resource = self._get_resource(url)
+        reset_at = headers.get("X-RateLimit-Reset")
+        self.buckets[resource].update(
+            int(remaining), int(reset_at) if reset_at else None
+        )
+
+    def metrics(self):
+        """Return the tokens spent and time waited for each resource."""
+        return {
+            resource: {
+                "tokens_spent": bucket.tokens_spent,
+                "time_waited": bucket.time_waited,
+            }
+            for resource, bucket in self.buckets.items()
+        }
+
+    def _get_resource(self, url):
+        if "/search/" in url:
+            return "search"
+        return "core"
+
+
+class Manager(BaseManager):
+    """Share a `RateLimiter` between processes."""
+
+
+Manager.register("RateLimiter", RateLimiter)
+
+
+class ThrottledRequests:
+    """Replacement of the `requests` module throttling the HTTP requests."""
+
+    def __init__(self, rate_limiter):
+        self.rate_limiter = rate_limiter
+
+    def __getattr__(self, name):
+        # Expose the rest of the 'requests' API (exceptions...)
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        self.rate_limiter.acquire(url)
+        response = requests.request(method, url, **kwargs)
+        self.rate_limiter.update(url, response.headers)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("patch", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("put", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("delete", url, **kwargs)
+
+
+def install(rate_limiter):
+    """Route the GitHub requests of oca-port through `rate_limiter`."""
+    oca_port_github.requests = ThrottledRequests(rate_limiter)
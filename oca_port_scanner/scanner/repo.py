@@ -1,15 +1,107 @@
 # Copyright 2023 Camptocamp SA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
 
+import collections
+import concurrent.futures.process
+import hashlib
+import importlib.metadata
 import json
 import logging
+import os
+import pathlib
+import threading
 import time
 
 import git
 import oca_port
 
+from .. import metrics
+from ..backend import compute_module_status
+from . import github
+
 logger = logging.getLogger(__name__)
 
+OCA_PORT_VERSION = importlib.metadata.version("oca-port")
+# Git mode of the tree entries (folders)
+TREE_MODE = "040000"
+
+FETCHES = metrics.registry.counter(
+    "oca_port_scanner_fetches_total",
+    "Fetches of repositories, by result ('fetched' or 'skipped').",
+)
+FETCH_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_fetch_seconds",
+    "Time spent fetching the branches of a repository.",
+)
+DIFF_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_diff_seconds",
+    "Time spent listing the modules updated on a branch.",
+)
+MODULES_DIFFED = metrics.registry.counter(
+    "oca_port_scanner_modules_diffed_total",
+    "Modules found updated on a branch.",
+)
+ANALYSES = metrics.registry.counter(
+    "oca_port_scanner_analyses_total",
+    "Modules to analyze, by result of the oca-port cache ('hit' or 'miss').",
+)
+ANALYSIS_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_analysis_seconds",
+    "Time spent by oca-port to analyze a module.",
+)
+DB_WRITE_SECONDS = metrics.registry.histogram(
+    "oca_port_scanner_db_write_seconds",
+    "Time spent saving the results of a scan, by stage ('modules' including"
+    " the stats triggers, 'cache', 'commits' and the whole 'transaction').",
+)
+
+
+class GitRepoCache:
+    """Keep `git.Repo` handles open across scans.
+
+    Each handle runs its own `git cat-file` processes and object caches, so
+    they are reused as much as possible. At most `size` handles are kept
+    open, the least recently used ones being closed first, unless they are
+    still in use.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._handles = collections.OrderedDict()
+        self._in_use = collections.Counter()
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        """Return the handle of the repository located at `path`."""
+        with self._lock:
+            handle = self._handles.pop(path, None) or git.Repo(path)
+            self._handles[path] = handle
+            self._in_use[path] += 1
+            self._evict()
+        return handle
+
+    def release(self, path):
+        """Flag the handle of `path` as not used anymore."""
+        with self._lock:
+            self._in_use[path] -= 1
+            if not self._in_use[path]:
+                del self._in_use[path]
+            self._evict()
+
+    def clear(self):
+        """Close all handles."""
+        with self._lock:
+            while self._handles:
+                self._handles.popitem()[1].close()
+            self._in_use.clear()
+
+    def _evict(self):
+        for path in list(self._handles):
+            if len(self._handles) <= self.size:
+                break
+            if path not in self._in_use:
+                self._handles.pop(path).close()
+
 
 class Repo:
     def __init__(self, app, name):
@@ -19,20 +111,50 @@ class Repo:
         self.path = self.app.storage.repositories_path.joinpath(
             *self.name.split("/")
         )
+        self._git_repo = None
+        # Modules updated between two commits, shared by the combinations
+        # of branches of a scan
+        self._modules_updated = {}
+        # Hits and misses of the oca-port results cache
+        self.cache_stats = collections.Counter()
 
-    def fetch(self):
-        """Clone or update the repository."""
+    @property
+    def git_repo(self):
+        """Git handle of the repository, kept until `close` is called."""
+        if self._git_repo is None:
+            self._git_repo = self.app.git_repos.acquire(self.path)
+        return self._git_repo
+
+    def close(self):
+        """Release the Git handle of the repository."""
+        if self._git_repo is not None:
+            self.app.git_repos.release(self.path)
+            self._git_repo = None
+
+    def fetch(self, branches=None):
+        """Clone or update the repository.
+
+        Only `branches` are updated if set, all branches to scan otherwise.
+        """
         if not self.is_cloned:
             self._clone()
-        self._fetch()
+        self._fetch(branches)
 
-    def scan(self):
-        """Scan the modules that have changed since last scan."""
-        for from_branch, to_branch in self.app.branches_matrix:
-            repo = git.Repo(self.path)
+    def scan(self, branches=None):
+        """Scan the modules that have changed since last scan.
+
+        Only the combinations of branches involving one of `branches` are
+        scanned if set.
+        """
+        repo = self.git_repo
+        branches_matrix = self.app.branches_matrix
+        if branches is not None:
+            branches_matrix = [
+                pair for pair in branches_matrix if set(pair) & set(branches)
+            ]
+        for from_branch, to_branch in branches_matrix:
             if not self._check_branches(repo, from_branch, to_branch):
                 continue
-            self._create_repository_entry(from_branch, to_branch)
             last_from_scan, last_to_scan = self._get_last_scanned_commits(
                 from_branch, to_branch
             )
@@ -56,17 +178,41 @@ class Repo:
                     len(modules_updated),
                     from_branch,
                 )
+                cache = self._get_cache(from_branch, to_branch)
+                from_commit = repo.commit(last_from_commit)
+                to_commit = repo.commit(last_to_commit)
+                modules_keys = {}
                 for module in modules_updated:
-                    data = self._scan_module(module, from_branch, to_branch)
+                    key = (
+                        self._get_tree_sha(from_commit, module),
+                        self._get_tree_sha(to_commit, module),
+                        OCA_PORT_VERSION,
+                    )
+                    # Module unchanged since last analysis: skip oca-port
+                    if cache.get(module) == key:
+                        self.cache_stats["hits"] += 1
+                        ANALYSES.inc(result="hit")
+                        continue
+                    self.cache_stats["misses"] += 1
+                    ANALYSES.inc(result="miss")
+                    modules_keys[module] = key
+                modules_data = {}
+                cache_entries = {}
+                for module, data in self._scan_modules(
+                    modules_keys, from_branch, to_branch
+                ):
+                    if data is not None:
+                        cache_entries[module] = modules_keys[module]
                     if data:
-                        self._save_module_data(
-                            module, from_branch, to_branch, data
-                        )
-                    time.sleep(3)  # Slow down to not hammer GitHub API
-            # Store last scanned commits
-            self._save_last_scanned_commits(
-                from_branch, to_branch, last_from_commit, last_to_commit
-            )
+                        modules_data[module] = data
+                self._save_scan_results(
+                    from_branch,
+                    to_branch,
+                    modules_data,
+                    cache_entries,
+                    last_from_commit,
+                    last_to_commit,
+                )
 
     @property
     def url(self):
@@ -78,26 +224,122 @@ class Repo:
 
     def _clone(self):
         logger.info("Clone %s", self.name)
-        git.Repo.clone_from(self.url, self.path)
+        options = []
+        # Partial clone, blobs being fetched on demand (e.g. 'blob:none')
+        clone_filter = self.app.config["options"].get("clone_filter")
+        if clone_filter:
+            options.append(f"--filter={clone_filter}")
+        git.Repo.clone_from(self.url, self.path, multi_options=options).close()
 
-    def _fetch(self):
-        repo = git.Repo(self.path)
-        remote_branches = [r.name for r in repo.remotes.origin.refs]
+    def _fetch(self, branches=None):
+        repo = self.git_repo
+        heads = self._get_remote_heads()
+        if self._are_heads_scanned(heads):
+            logger.info("%s: no new commits, skip fetch", self.name)
+            FETCHES.inc(result="skipped")
+            return
+        if branches is not None:
+            heads = {b: c for b, c in heads.items() if b in branches}
+            if not heads:
+                FETCHES.inc(result="skipped")
+                return
+        logger.info("%s: fetch branches %s", self.name, ", ".join(heads))
+        # Fetch all branches at once with a single negotiation
+        refspecs = [
+            f"+refs/heads/{branch}:refs/remotes/origin/{branch}"
+            for branch in heads
+        ]
+        size = self._get_objects_size()
+        start = time.perf_counter()
+        repo.remotes.origin.fetch(refspecs)
+        duration = time.perf_counter() - start
+        FETCHES.inc(result="fetched")
+        FETCH_SECONDS.observe(duration)
         logger.info(
-            "%s: fetch branches %s", self.name, ", ".join(self.app.branches)
+            "%s: fetched in %.1fs (%s KiB received)",
+            self.name,
+            duration,
+            self._get_objects_size() - size,
         )
-        for branch in self.app.branches:
-            if f"origin/{branch}" in remote_branches:
-                repo.remotes.origin.fetch(branch)
+
+    def _get_remote_heads(self):
+        """Return the last commit of each branch to scan on the remote."""
+        output = self.git_repo.git.ls_remote(
+            "--heads",
+            "origin",
+            *[f"refs/heads/{branch}" for branch in self.app.branches],
+        )
+        heads = {}
+        for line in output.splitlines():
+            commit, ref = line.split()
+            heads[ref.removeprefix("refs/heads/")] = commit
+        return heads
+
+    def _are_heads_scanned(self, heads):
+        """Return `True` if all branch `heads` have already been scanned."""
+        query = """
+            SELECT from_version, to_version, from_commit, to_commit
+            FROM repositories
+            WHERE org=? AND name=?;
+        """
+        args = (self.upstream, self.techname)
+        with self.app.backend.transaction() as cr:
+            cr.execute(query, args)
+            scanned = {(row[0], row[1]): row[2:] for row in cr.fetchall()}
+        for from_branch, to_branch in self.app.branches_matrix:
+            if from_branch not in heads or to_branch not in heads:
+                continue
+            commits = (heads[from_branch], heads[to_branch])
+            if scanned.get((from_branch, to_branch)) != commits:
+                return False
+        return True
+
+    def _get_objects_size(self):
+        """Return the size of the Git objects stored locally (in KiB)."""
+        output = self.git_repo.git.count_objects("-v")
+        stats = dict(line.split(": ") for line in output.splitlines())
+        return int(stats["size"]) + int(stats["size-pack"])
 
     def _check_branches(self, repo, from_branch, to_branch):
         refs = [r.name for r in repo.remotes.origin.refs]
         fbranch, tbranch = f"origin/{from_branch}", f"origin/{to_branch}"
         return fbranch in refs and tbranch in refs
 
-    def _create_repository_entry(self, from_branch, to_branch):
-        con = self.app.backend.db
-        cr = con.cursor()
+    def _save_scan_results(
+        self,
+        from_branch,
+        to_branch,
+        modules_data,
+        cache_entries,
+        from_commit,
+        to_commit,
+    ):
+        """Save the results of a scan for the given branches.
+
+        Modules data are written along with the last scanned commits in a
+        single transaction, so commits are never flagged as scanned without
+        their data.
+        """
+        # The whole transaction, including the wait for the writer lock and
+        # the commit
+        with DB_WRITE_SECONDS.time(stage="transaction"):
+            with self.app.backend.transaction() as cr:
+                self._create_repository_entry(cr, from_branch, to_branch)
+                with DB_WRITE_SECONDS.time(stage="modules"):
+                    self._save_modules_data(
+                        cr, from_branch, to_branch, modules_data
+                    )
+                with DB_WRITE_SECONDS.time(stage="cache"):
+                    self._save_cache(cr, from_branch, to_branch, cache_entries)
+                # Store last scanned commits
+                with DB_WRITE_SECONDS.time(stage="commits"):
+                    self._save_last_scanned_commits(
+                        cr, from_branch, to_branch, from_commit, to_commit
+                    )
+                # Invalidate the responses cached by the HTTP server
+                self.app.backend.bump_generation(cr)
+
+    def _create_repository_entry(self, cr, from_branch, to_branch):
         # Create repository entry
         query = """
             INSERT OR IGNORE INTO repositories(
@@ -110,9 +352,32 @@ class Repo:
         """
         args = (self.upstream, self.techname, from_branch, to_branch)
         cr.execute(query, args)
-        con.commit()
 
-    def _scan_module(self, module, from_branch, to_branch):
+    def _scan_modules(self, modules, from_branch, to_branch):
+        """Analyze `modules` with oca-port, yielding their results.
+
+        Analyses are distributed to the pool of processes of the app if any,
+        results being yielded as soon as they are available.
+        """
+        params = [
+            self._get_scan_params(module, from_branch, to_branch)
+            for module in modules
+        ]
+        pool = self.app.analysis_pool
+        try:
+            if pool:
+                results = pool.map(analyze_module, params)
+            else:
+                results = map(analyze_module, params)
+            for module, (data, duration) in zip(modules, results):
+                ANALYSIS_SECONDS.observe(duration)
+                yield module, data
+        except concurrent.futures.process.BrokenProcessPool:
+            # The scan fails, but the next ones run in a new pool
+            self.app.restart_analysis_pool(pool)
+            raise
+
+    def _get_scan_params(self, module, from_branch, to_branch):
         logger.info(
             "%s: scan '%s' (%s -> %s)",
             self.name,
@@ -120,8 +385,8 @@ class Repo:
             from_branch,
             to_branch,
         )
-        # Initialize the oca-port app
-        params = {
+        # Parameters of the oca-port app
+        return {
             "from_branch": from_branch,
             "to_branch": to_branch,
             "addon": module,
@@ -132,20 +397,11 @@ class Repo:
             "output": "json",
             "fetch": False,
         }
-        scan = oca_port.App(**params)
-        try:
-            json_data = scan.run()
-        except ValueError as exc:
-            logger.warning(exc)
-        else:
-            return json.loads(json_data)
-
-    def _save_module_data(self, module, from_branch, to_branch, data):
-        con = self.app.backend.db
-        cr = con.cursor()
-        # Create or update module entry
+
+    def _save_modules_data(self, cr, from_branch, to_branch, modules_data):
+        # Create or update module entries
         query = """
-            INSERT OR REPLACE INTO modules(
+            INSERT INTO modules(
                 org,
                 repo,
                 module,
@@ -153,91 +409,185 @@ class Repo:
                 to_version,
                 process,
                 existing_pr,
-                results
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                results,
+                status,
+                nb_missing_commits,
+                pr_urls
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (org, repo, module, from_version, to_version)
+            DO UPDATE SET
+                process=excluded.process,
+                existing_pr=excluded.existing_pr,
+                results=excluded.results,
+                status=excluded.status,
+                nb_missing_commits=excluded.nb_missing_commits,
+                pr_urls=excluded.pr_urls;
         """
-        existing_pr = results = None
-        if data.get("results"):
-            results = json.dumps(data["results"])
-            if data.get("process") == "migrate":
-                existing_pr = json.dumps(data["results"].get("existing_pr"))
-        args = (
-            self.upstream,
-            self.techname,
-            module,
-            from_branch,
-            to_branch,
-            data.get("process"),
-            existing_pr,
-            results,
-        )
-        cr.execute(query, args)
-        con.commit()
+        args = []
+        for module, data in modules_data.items():
+            existing_pr = results = None
+            if data.get("results"):
+                results = json.dumps(data["results"])
+                if data.get("process") == "migrate":
+                    existing_pr = json.dumps(
+                        data["results"].get("existing_pr")
+                    )
+            args.append(
+                (
+                    self.upstream,
+                    self.techname,
+                    module,
+                    from_branch,
+                    to_branch,
+                    data.get("process"),
+                    existing_pr,
+                    results,
+                    # Computed once here so reads do not parse the results
+                    *compute_module_status(
+                        data.get("process"), data.get("results") or {}
+                    ),
+                )
+            )
+        cr.executemany(query, args)
+
+    def _get_cache(self, from_branch, to_branch):
+        """Return the key of the cached oca-port results of each module."""
+        query = """
+            SELECT module, from_tree, to_tree, oca_port_version
+            FROM oca_port_cache
+            WHERE org=? AND repo=? AND from_version=? AND to_version=?;
+        """
+        args = (self.upstream, self.techname, from_branch, to_branch)
+        with self.app.backend.transaction() as cr:
+            cr.execute(query, args)
+            return {row[0]: row[1:] for row in cr.fetchall()}
+
+    def _save_cache(self, cr, from_branch, to_branch, cache_entries):
+        query = """
+            INSERT INTO oca_port_cache(
+                org,
+                repo,
+                module,
+                from_version,
+                to_version,
+                from_tree,
+                to_tree,
+                oca_port_version
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (org, repo, module, from_version, to_version)
+            DO UPDATE SET
+                from_tree=excluded.from_tree,
+                to_tree=excluded.to_tree,
+                oca_port_version=excluded.oca_port_version;
+        """
+        args = [
+            (
+                self.upstream,
+                self.techname,
+                module,
+                from_branch,
+                to_branch,
+                *key,
+            )
+            for module, key in cache_entries.items()
+        ]
+        cr.executemany(query, args)
+
+    def _get_tree_sha(self, commit, module):
+        """Return a hash of the `module` tree in `commit` (if any).
+
+        Translations are left out as oca-port ignores them, so commits only
+        updating them do not trigger a new analysis.
+        """
+        try:
+            tree = commit.tree[module]
+        except KeyError:
+            return ""
+        sha = hashlib.sha1()
+        for item in tree:
+            if item.name != "i18n":
+                sha.update(
+                    f"{item.mode:o} {item.name} {item.hexsha}\n".encode()
+                )
+        return sha.hexdigest()
 
     def _get_last_scanned_commits(self, from_branch, to_branch):
-        con = self.app.backend.db
-        cr = con.cursor()
         query = """
             SELECT from_commit, to_commit
             FROM repositories
             WHERE org=? AND name=? AND from_version=? AND to_version=?;
         """
         args = (self.upstream, self.techname, from_branch, to_branch)
-        cr.execute(query, args)
-        res = cr.fetchone()
+        with self.app.backend.transaction() as cr:
+            cr.execute(query, args)
+            res = cr.fetchone()
         if res:
             return res[0], res[1]
         return None, None
 
     def _save_last_scanned_commits(
-        self, from_branch, to_branch, from_commit, to_commit
+        self, cr, from_branch, to_branch, from_commit, to_commit
     ):
-        con = self.app.backend.db
-        cr = con.cursor()
         query = """
             UPDATE repositories
-            SET from_commit=?, to_commit=?
+            SET from_commit=?, to_commit=?, last_change_at=?
             WHERE org=? AND name=? AND from_version=? AND to_version=?;
         """
         args = (
             from_commit,
             to_commit,
+            time.time(),
             self.upstream,
             self.techname,
             from_branch,
             to_branch,
         )
         cr.execute(query, args)
-        con.commit()
 
     def _get_modules_updated(self, from_commit, to_commit):
-        """Return modules updated between `from_commit` and `to_commit`."""
+        """Return modules updated between `from_commit` and `to_commit`.
+
+        A branch being part of several combinations of branches, its
+        updated modules are computed once and shared by all of them.
+        """
         # Same commits: nothing has changed
-        modules = set()
         if from_commit == to_commit:
-            return modules
-        repo = git.Repo(self.path)
+            return set()
+        key = (from_commit, to_commit)
+        if key not in self._modules_updated:
+            with DIFF_SECONDS.time():
+                modules = self._compute_modules_updated(from_commit, to_commit)
+            MODULES_DIFFED.inc(len(modules))
+            self._modules_updated[key] = modules
+        return self._modules_updated[key]
+
+    def _compute_modules_updated(self, from_commit, to_commit):
+        repo = self.git_repo
         if not from_commit:
             # No from_commit means first scan: return all available modules
             to_commit = repo.commit(to_commit)
-            modules = {
+            return {
                 tree.path
                 for tree in to_commit.tree.trees
                 if self._filter_module_path(tree.path)
             }
-        else:
-            # Get only modules updated between the two commits
-            from_commit, to_commit = repo.commit(from_commit), repo.commit(
-                to_commit
-            )
-            diffs = to_commit.diff(from_commit, R=True)
-            for diff in diffs:
-                # Exclude files located in root folder
-                if "/" not in diff.a_path:
-                    continue
-                path = diff.a_path.split("/", maxsplit=1)[0]
-                if self._filter_module_path(path):
-                    modules.add(path)
+        # Get only modules updated between the two commits, by comparing the
+        # entries of their root trees: neither the content of the files nor
+        # the sub-trees have to be read. Entries are separated by NUL
+        # characters, so Git does not quote the paths (e.g. non-ASCII ones)
+        output = repo.git.diff_tree(
+            "-z", "--no-renames", from_commit, to_commit
+        )
+        fields = output.split("\0")
+        modules = set()
+        # ':<old mode> <new mode> <old sha> <new sha> <status>\0<path>\0'
+        for info, path in zip(fields[0::2], fields[1::2]):
+            old_mode, new_mode = info[1:].split()[:2]
+            # Exclude files located in root folder
+            if TREE_MODE not in (old_mode, new_mode):
+                continue
+            if self._filter_module_path(path):
+                modules.add(path)
         return modules
 
     def _filter_module_path(self, path):
@@ -248,3 +598,45 @@ class Repo:
         ):
             return False
         return True
+
+
+def init_analysis_worker(rate_limiter, slots, cache_path):
+    """Initialize a process of the pool running oca-port analyses.
+
+    oca-port stores the data of the commits of a repository in a cache
+    file read when an analysis starts and entirely rewritten once it is
+    done, so concurrent analyses of the modules of a repository would
+    overwrite the updates of each other. Each process uses its own cache
+    folder, taken from the `slots` queue to reuse the same folders (and
+    their data) when the scanner restarts.
+
+    The Git repository is shared: analyses only read it (without any
+    checkout), each process opening its own handle on it.
+    """
+    os.environ["XDG_CACHE_HOME"] = str(
+        pathlib.Path(cache_path, f"analysis-{slots.get()}")
+    )
+    # Do not let Git refresh the index of the shared repository
+    os.environ["GIT_OPTIONAL_LOCKS"] = "0"
+    github.install(rate_limiter)
+
+
+def analyze_module(params):
+    """Run oca-port with `params` and return its results.
+
+    Return a tuple `(results, duration)`, `results` being `None` if the
+    module can't be analyzed.
+
+    Defined at module level to be run by a pool of processes, each oca-port
+    app opening its own handle on the Git repository.
+    """
+    start = time.perf_counter()
+    scan = oca_port.App(**params)
+    try:
+        json_data = scan.run()
+    except ValueError as exc:
+        logger.warning(exc)
+        results = None
+    else:
+        results = json.loads(json_data)
+    return results, time.perf_counter() - start
@@ -0,0 +1,123 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import time
+
+# Bounds of the delay between two scans of a repository (in seconds), can be
+# overridden with the 'scan_min_interval' and 'scan_max_interval' options
+DEFAULT_MIN_INTERVAL = 600
+DEFAULT_MAX_INTERVAL = 86400
+# Part of the time elapsed since the last change of a repository used as
+# delay before its next scan
+BACKOFF_RATIO = 0.25
+
+
+class Scheduler:
+    """Schedule the scans of repositories according to their activity.
+
+    A repository is scanned again after a delay proportional to the time
+    elapsed since its last change: active repositories are polled often,
+    while the delay of dormant ones grows exponentially with each scan that
+    finds nothing new. Repositories never scanned are due immediately.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        options = self.app.config["options"]
+        self.min_interval = options.get(
+            "scan_min_interval", DEFAULT_MIN_INTERVAL
+        )
+        self.max_interval = options.get(
+            "scan_max_interval", DEFAULT_MAX_INTERVAL
+        )
+
+    def get_queue(self):
+        """Return the repositories with the time of their next scan.
+
+        Repositories are sorted by their time of next scan, those never
+        scanned coming first (with a time of 0).
+        """
+        with self.app.backend.transaction() as cr:
+            cr.execute("SELECT repository, next_scan_at FROM scan_schedule;")
+            next_scans = dict(cr.fetchall())
+        queue = [
+            (repository, next_scans.get(repository) or 0)
+            for repository in self.app.repositories
+        ]
+        return sorted(queue, key=lambda item: item[1])
+
+    def get_due_repositories(self):
+        """Return the repositories to scan now, the most overdue first."""
+        now = time.time()
+        return [repo for repo, next_at in self.get_queue() if next_at <= now]
+
+    def reschedule(self, repository):
+        """Schedule the next scan of `repository`, just scanned."""
+        now = time.time()
+        org, name = repository.split("/", maxsplit=1)
+        with self.app.backend.transaction() as cr:
+            cr.execute(
+                """
+                SELECT MAX(last_change_at)
+                FROM repositories
+                WHERE org=? AND name=?;
+                """,
+                (org, name),
+            )
+            last_change_at = cr.fetchone()[0]
+            next_scan_at = now + self._get_interval(now, last_change_at)
+            cr.execute(
+                """
+                INSERT INTO scan_schedule(
+                    repository,
+                    last_scan_at,
+                    next_scan_at
+                ) VALUES (?, ?, ?)
+                ON CONFLICT (repository)
+                DO UPDATE SET
+                    last_scan_at=excluded.last_scan_at,
+                    next_scan_at=excluded.next_scan_at;
+                """,
+                (repository, now, next_scan_at),
+            )
+        return next_scan_at
+
+    def get_jobs(self):
+        """Return the branches queued to be scanned for each repository.
+
+        Branches are returned with the time they have been queued, as
+        `{repository: {branch: created_at}}`.
+        """
+        with self.app.backend.transaction() as cr:
+            cr.execute("SELECT repository, branch, created_at FROM scan_jobs;")
+            rows = cr.fetchall()
+        jobs = {}
+        for repository, branch, created_at in rows:
+            jobs.setdefault(repository, {})[branch] = created_at
+        return jobs
+
+    def remove_jobs(self, jobs):
+        """Remove the `jobs` done from the queue.
+
+        Branches queued again since `jobs` have been read are kept.
+        """
+        args = [
+            (repository, branch, created_at)
+            for repository, branches in jobs.items()
+            for branch, created_at in branches.items()
+        ]
+        with self.app.backend.transaction() as cr:
+            cr.executemany(
+                """
+                DELETE FROM scan_jobs
+                WHERE repository=? AND branch=? AND created_at<=?;
+                """,
+                args,
+            )
+
+    def _get_interval(self, now, last_change_at):
+        if last_change_at is None:
+            # Nothing to scan in the repository (no branches found)
+            return self.max_interval
+        interval = (now - last_change_at) * BACKOFF_RATIO
+        return min(max(interval, self.min_interval), self.max_interval)
@@ -0,0 +1,248 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+from .backend import get_pr_data
+
+# Formats of the snapshots, with their media type
+FORMATS = {
+    "json": "application/json",
+    "csv": "text/csv",
+}
+MANIFEST_FILENAME = "manifest.json"
+# Columns of the CSV snapshots
+CSV_FIELDS = [
+    "repository",
+    "module",
+    "process",
+    "status",
+    "nb_missing_commits",
+    "pr_urls",
+]
+# Number of rows read at once when exporting a pair of versions
+FETCH_SIZE = 1000
+
+
+class Snapshots:
+    """Compressed exports of the modules of each pair of versions.
+
+    Snapshots are exported by the scanner at the end of its cycles if the
+    data has changed, and served as is by the HTTP server. Files are never
+    modified once written: each export writes new files named after the
+    generation of the data, then atomically replaces the manifest listing
+    them. Files of the previous export are kept until the next one, so
+    they can still be served while the manifest is being replaced.
+    """
+
+    def __init__(self, config, backend):
+        self.config = config
+        self.backend = backend
+        options = self.config["options"]
+        self.path = pathlib.Path(
+            options.get("snapshots_path")
+            or pathlib.Path(options["database_path"]).parent.joinpath(
+                "snapshots"
+            )
+        )
+
+    def get_manifest(self):
+        """Return the manifest of the last export, or `None`."""
+        try:
+            with open(self.path.joinpath(MANIFEST_FILENAME)) as file_:
+                return json.load(file_)
+        except FileNotFoundError:
+            return None
+
+    def get_file(self, from_version, to_version, format_):
+        """Return the path and generation of a snapshot, or `None`."""
+        manifest = self.get_manifest()
+        if not manifest:
+            return None
+        for snapshot in manifest["snapshots"]:
+            if (snapshot["from_version"], snapshot["to_version"]) == (
+                from_version,
+                to_version,
+            ):
+                filename = snapshot["files"].get(format_)
+                if filename:
+                    return self.path.joinpath(filename), manifest["generation"]
+        return None
+
+    def export(self):
+        """Export the snapshots if the data changed since the last export.
+
+        Return `True` if snapshots have been exported.
+        """
+        generation = self.backend.get_generation()
+        previous = self.get_manifest()
+        if previous and previous["generation"] == generation:
+            return False
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self.backend.reader() as cr:
+            cr.execute(
+                """
+                SELECT from_version, to_version
+                FROM versions
+                WHERE nb_modules > 0
+                ORDER BY from_version, to_version;
+                """
+            )
+            pairs = cr.fetchall()
+        snapshots = []
+        for from_version, to_version in pairs:
+            name = f"modules-{from_version}-{to_version}-{generation}"
+            files = {format_: f"{name}.{format_}.gz" for format_ in FORMATS}
+            self._export_pair(from_version, to_version, files)
+            snapshots.append(
+                {
+                    "from_version": from_version,
+                    "to_version": to_version,
+                    "files": files,
+                }
+            )
+        manifest = {
+            "generation": generation,
+            "exported_at": time.time(),
+            "snapshots": snapshots,
+        }
+        with self._write_file(MANIFEST_FILENAME) as file_:
+            file_.write(json.dumps(manifest, indent=4).encode())
+        self._remove_old_files(manifest, previous)
+        return True
+
+    def _export_pair(self, from_version, to_version, files):
+        """Write the JSON and CSV snapshots of a pair of versions.
+
+        Modules are read once and written in both files while iterating on
+        them. JSON snapshots hold a list of modules serialized like the
+        `Module` model of the API.
+        """
+        query = """
+            SELECT
+                m.org,
+                m.repo,
+                m.module,
+                m.process,
+                m.status,
+                m.nb_missing_commits,
+                m.pr_urls,
+                m.existing_pr,
+                r.nb_modules,
+                r.nb_modules_migrated,
+                r.nb_modules_to_migrate,
+                r.nb_modules_to_review,
+                r.nb_modules_to_port_commits
+            FROM modules AS m
+            LEFT JOIN repositories AS r
+                ON r.org=m.org
+                AND r.name=m.repo
+                AND r.from_version=m.from_version
+                AND r.to_version=m.to_version
+            WHERE m.from_version=? AND m.to_version=?
+            ORDER BY m.org, m.repo, m.module;
+        """
+        json_path, csv_path = files["json"], files["csv"]
+        with self._write_file(json_path, compress=True) as json_file:
+            with self._write_file(csv_path, compress=True) as csv_file:
+                with self.backend.reader() as cr:
+                    cr.execute(query, (from_version, to_version))
+                    self._write_rows(
+                        from_version, to_version, cr, json_file, csv_file
+                    )
+
+    def _write_rows(self, from_version, to_version, cr, json_file, csv_file):
+        csv_buffer = io.StringIO()
+        writer = csv.DictWriter(csv_buffer, CSV_FIELDS)
+        writer.writeheader()
+        separator = b"["
+        while rows := cr.fetchmany(FETCH_SIZE):
+            for row in rows:
+                data = self._get_module_data(from_version, to_version, row)
+                json_file.write(separator + json.dumps(data).encode())
+                separator = b","
+                writer.writerow(
+                    {
+                        "repository": data["repository"]["fullname"],
+                        "module": data["name"],
+                        "process": data["process"],
+                        "status": data["status"],
+                        "nb_missing_commits": data["nb_missing_commits"],
+                        "pr_urls": row[6],
+                    }
+                )
+            csv_file.write(csv_buffer.getvalue().encode())
+            csv_buffer.seek(0)
+            csv_buffer.truncate()
+        csv_file.write(csv_buffer.getvalue().encode())
+        json_file.write(b"[]" if separator == b"[" else b"]")
+
+    @staticmethod
+    def _get_module_data(from_version, to_version, row):
+        return {
+            "name": row[2],
+            "from_version": from_version,
+            "to_version": to_version,
+            "process": row[3],
+            "status": row[4],
+            "nb_missing_commits": row[5],
+            "repository": {
+                "org": row[0],
+                "name": row[1],
+                "from_version": from_version,
+                "to_version": to_version,
+                "nb_modules": row[8],
+                "nb_modules_migrated": row[9],
+                "nb_modules_to_migrate": row[10],
+                "nb_modules_to_review": row[11],
+                "nb_modules_to_port_commits": row[12],
+                "fullname": f"{row[0]}/{row[1]}",
+            },
+            "existing_pr": get_pr_data(row[7]),
+        }
+
+    @contextlib.contextmanager
+    def _write_file(self, filename, compress=False):
+        """Return a binary file object writing `filename` atomically.
+
+        Data is written in a temporary file renamed once complete, so the
+        file is never read partially written.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        try:
+            with open(fd, "wb") as raw_file:
+                if compress:
+                    # No timestamp in the header: same data, same file
+                    with gzip.GzipFile(
+                        fileobj=raw_file, mode="wb", compresslevel=6, mtime=0
+                    ) as file_:
+                        yield file_
+                else:
+                    yield raw_file
+                raw_file.flush()
+                os.fsync(raw_file.fileno())
+            os.replace(tmp_path, self.path.joinpath(filename))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _remove_old_files(self, manifest, previous):
+        """Remove the files not listed in `manifest` nor `previous`."""
+        kept = {MANIFEST_FILENAME}
+        for manifest_ in (manifest, previous or {"snapshots": []}):
+            for snapshot in manifest_["snapshots"]:
+                kept.update(snapshot["files"].values())
+        for path in self.path.glob("modules-*.gz"):
+            if path.name not in kept:
+                path.unlink()
+        # Left by an interrupted export
+        for path in self.path.glob(".tmp-*"):
+            path.unlink()
@@ -0,0 +1,45 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+"""Tasks run by the analysis pool in the tests.
+
+They are defined out of the test modules, whose import would set up the
+test environment again in the processes of the pool.
+"""
+
+import os
+import time
+import types
+
+COMMITS = 10
+
+
+def get_environ(_):
+    time.sleep(0.1)
+    return os.getpid(), os.environ["XDG_CACHE_HOME"]
+
+
+def analyze(number):
+    """Update the oca-port cache of a repository like an analysis."""
+    from oca_port.utils.cache import UserCache
+
+    source = types.SimpleNamespace(
+        org="OCA", repo="server-tools", addon=f"module_{number}"
+    )
+    app = types.SimpleNamespace(
+        source=source,
+        target=source,
+        from_branch=types.SimpleNamespace(name="14.0"),
+        to_branch=types.SimpleNamespace(name="16.0"),
+        upstream_org="OCA",
+        repo_name="server-tools",
+    )
+    cache = UserCache(app)
+    time.sleep(0.01)
+    for commit in range(COMMITS):
+        cache.set_commit_files(f"{number:04d}{commit:036d}", [])
+    cache.save()
+
+
+def crash(_):
+    """Kill the process of the pool running it, breaking the pool."""
+    os._exit(1)
@@ -0,0 +1,76 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+
+import pytest
+import schedule
+
+# The configuration is read when the HTTP app is imported: it has to be
+# written in a temporary folder before any test module imports it
+TMP_PATH = pathlib.Path(tempfile.mkdtemp(prefix="oca-port-scanner-tests-"))
+os.environ["XDG_CONFIG_HOME"] = str(TMP_PATH.joinpath("config"))
+os.environ["XDG_DATA_HOME"] = str(TMP_PATH.joinpath("data"))
+os.environ["XDG_CACHE_HOME"] = str(TMP_PATH.joinpath("cache"))
+
+from oca_port_scanner.config import Config  # noqa: E402
+
+WEBHOOK_SECRET = "secret"
+CONFIG = {
+    "options": {
+        "repositories_path": str(TMP_PATH.joinpath("repositories")),
+        "database_path": str(TMP_PATH.joinpath("data.db")),
+        "workers": 1,
+        "webhook_secret": WEBHOOK_SECRET,
+        "http_cache_size": 0,
+    },
+    "branches_matrix": [("14.0", "16.0")],
+    "repositories": ["OCA/server-tools"],
+}
+config_path = Config._get_config_path()
+config_path.parent.mkdir(parents=True)
+config_path.write_text(json.dumps(CONFIG))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP_PATH, ignore_errors=True)
+
+
+@pytest.fixture
+def backend():
+    """Return the backend of the HTTP app, on an empty database."""
+    from oca_port_scanner.http import models
+
+    with models.backend.transaction() as cr:
+        for table in (
+            "modules",
+            "repositories",
+            "scan_jobs",
+            "scan_schedule",
+        ):
+            cr.execute(f"DELETE FROM {table};")
+        models.backend.bump_generation(cr)
+    return models.backend
+
+
+@pytest.fixture
+def client(backend):
+    from fastapi.testclient import TestClient
+
+    from oca_port_scanner import http
+
+    return TestClient(http.app)
+
+
+@pytest.fixture
+def scanner(backend):
+    """Return the scanner app, sharing the database of the HTTP app."""
+    from oca_port_scanner.scanner.app import App
+
+    app = App()
+    yield app
+    schedule.clear()
@@ -0,0 +1,83 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import concurrent.futures.process
+import json
+import multiprocessing
+
+import pytest
+
+from oca_port_scanner.scanner import github
+from oca_port_scanner.scanner.repo import Repo, init_analysis_worker
+
+from .analysis_tasks import COMMITS, analyze, crash, get_environ
+from .conftest import TMP_PATH
+
+WORKERS = 2
+
+
+@pytest.fixture
+def pool():
+    cache_path = TMP_PATH.joinpath("analysis-pool")
+    context = multiprocessing.get_context("spawn")
+    manager = github.Manager(ctx=context)
+    manager.start()
+    slots = context.Queue()
+    for slot in range(WORKERS):
+        slots.put(slot)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=WORKERS,
+        mp_context=context,
+        initializer=init_analysis_worker,
+        initargs=(manager.RateLimiter(), slots, cache_path),
+    ) as pool_:
+        yield pool_, cache_path
+    manager.shutdown()
+
+
+def test_worker_caches(pool):
+    pool, cache_path = pool
+    environs = dict(pool.map(get_environ, range(WORKERS * 2)))
+    # One cache folder per process
+    assert len(set(environs.values())) == len(environs)
+    assert set(environs.values()) <= {
+        str(cache_path.joinpath(f"analysis-{slot}")) for slot in range(WORKERS)
+    }
+
+
+def test_worker_caches_concurrent_analyses(pool):
+    pool, cache_path = pool
+    list(pool.map(analyze, range(40)))
+    commits = set()
+    for path in cache_path.glob("analysis-*/**/commits_data/OCA/*.json"):
+        commits.update(json.loads(path.read_text()))
+    # No analysis lost the commits saved by another one
+    assert len(commits) == 40 * COMMITS
+
+
+def test_restart_broken_pool(scanner):
+    scanner.analysis_workers = WORKERS
+    scanner._init_analysis_pool()
+    pool = scanner.analysis_pool
+    try:
+        with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+            pool.submit(crash, 0).result()
+        repo = Repo(scanner, "OCA/server-tools")
+        # The scan fails, restarting the pool
+        with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+            list(repo._scan_modules(["module_a"], "14.0", "16.0"))
+        assert scanner.analysis_pool is not pool
+        new_pool = scanner.analysis_pool
+        # Already restarted by another scan
+        scanner.restart_analysis_pool(pool)
+        assert scanner.analysis_pool is new_pool
+        environs = dict(new_pool.map(get_environ, range(WORKERS * 2)))
+        # The cache folders of the processes are taken again
+        assert len(set(environs.values())) == len(environs)
+        assert set(environs.values()) <= {
+            str(scanner._get_cache_path().joinpath(f"analysis-{slot}"))
+            for slot in range(WORKERS)
+        }
+    finally:
+        scanner.analysis_pool.shutdown()
+        scanner._manager.shutdown()
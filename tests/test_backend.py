@@ -0,0 +1,265 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import concurrent.futures
+import json
+import sqlite3
+
+import pytest
+
+from oca_port_scanner.backend import Backend
+
+STATS_QUERY = """
+    SELECT
+        nb_modules,
+        nb_modules_migrated,
+        nb_modules_to_migrate,
+        nb_modules_to_review,
+        nb_modules_to_port_commits
+    FROM repositories;
+"""
+
+
+def get_config(tmp_path):
+    return {"options": {"database_path": str(tmp_path.joinpath("data.db"))}}
+
+
+def get_version(backend):
+    return backend.db.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def test_concurrent_migrations(tmp_path):
+    # The scanner and the HTTP server migrate the database on startup
+    config = get_config(tmp_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(Backend, config, check_same_thread=False)
+            for __ in range(4)
+        ]
+        backends = [future.result() for future in futures]
+    versions = {get_version(backend) for backend in backends}
+    assert len(versions) == 1
+    assert versions.pop() > 0
+
+
+def test_failed_migration(tmp_path, monkeypatch):
+    def migrate(self, cr):
+        cr.execute("CREATE TABLE search_stats (query CHAR);")
+        raise RuntimeError("Migration failed")
+
+    monkeypatch.setattr(Backend, "_migrate_modules_search", migrate)
+    config = get_config(tmp_path)
+    with pytest.raises(RuntimeError):
+        Backend(config)
+    monkeypatch.undo()
+    backend = Backend(config)
+    tables = backend.db.execute(
+        "SELECT name FROM sqlite_master WHERE name='search_stats';"
+    ).fetchall()
+    assert tables == []
+    assert not backend.db.in_transaction
+
+
+def test_migrate_modules_status(tmp_path, monkeypatch):
+    def migrate(self, cr):
+        raise RuntimeError("Stop before the modules status")
+
+    # Stop the migrations at the version storing only the JSON results
+    monkeypatch.setattr(Backend, "_migrate_modules_status", migrate)
+    config = get_config(tmp_path)
+    with pytest.raises(RuntimeError):
+        Backend(config)
+    monkeypatch.undo()
+    db = sqlite3.connect(config["options"]["database_path"])
+    assert db.execute("PRAGMA user_version;").fetchone()[0] == 3
+    repository = ("OCA", "server-tools", "14.0", "16.0")
+    db.execute(
+        """
+        INSERT INTO repositories (org, name, from_version, to_version)
+        VALUES (?, ?, ?, ?);
+        """,
+        repository,
+    )
+    pr = {"url": "https://github.com/OCA/server-tools/pull/1"}
+    commits = {"missing_commits": ["a", "b"]}
+    modules = [
+        ("available", None, None),
+        ("migrate_no_pr", "migrate", {"existing_pr": None}),
+        ("migrate_no_results", "migrate", None),
+        ("to_review", "migrate", {"existing_pr": pr}),
+        ("port_commits", "port_commits", {"1": dict(commits, url="")}),
+        ("port_commits_pr", "port_commits", {"1": dict(commits, **pr)}),
+    ]
+    db.executemany(
+        """
+        INSERT INTO modules (
+            org, repo, from_version, to_version, module, process, results
+        ) VALUES (?, ?, ?, ?, ?, ?, ?);
+        """,
+        [
+            (*repository, module, process, results and json.dumps(results))
+            for module, process, results in modules
+        ],
+    )
+    db.commit()
+    # Counted by the triggers of the first migration from the JSON results
+    stats = db.execute(STATS_QUERY).fetchall()
+    assert stats == [(6, 3, 1, 2, 2)]
+    db.close()
+    backend = Backend(config)
+    rows = backend.db.execute(
+        """
+        SELECT module, status, nb_missing_commits, pr_urls
+        FROM modules ORDER BY module;
+        """
+    ).fetchall()
+    assert rows == [
+        ("available", "available", 0, None),
+        ("migrate_no_pr", "migrate", 0, None),
+        ("migrate_no_results", "migrate", 0, None),
+        ("port_commits", "port_commits", 2, ""),
+        ("port_commits_pr", "port_commits", 2, pr["url"]),
+        ("to_review", "to review", 0, pr["url"]),
+    ]
+    assert backend.check_repositories_stats() == []
+    assert backend.check_versions_stats() == []
+    stats = backend.db.execute(STATS_QUERY).fetchall()
+    assert stats == [(6, 3, 2, 1, 2)]
+
+
+def assert_stats(backend):
+    """Check the stats maintained by the triggers against a full count."""
+    fields = ", ".join(Backend._repositories_stats)
+    expected = backend.db.execute(
+        backend._repositories_stats_query()
+    ).fetchall()
+    stats = backend.db.execute(
+        f"""
+        SELECT org, name, from_version, to_version, {fields}
+        FROM repositories WHERE nb_modules > 0;
+        """
+    ).fetchall()
+    assert sorted(stats) == sorted(expected)
+    assert backend.check_repositories_stats() == []
+    expected = backend.db.execute(backend._versions_stats_query()).fetchall()
+    stats = backend.db.execute(
+        f"SELECT from_version, to_version, {fields} FROM versions;"
+    ).fetchall()
+    assert sorted(stats) == sorted(expected)
+    assert backend.check_versions_stats() == []
+
+
+def test_repositories_stats_triggers(tmp_path):
+    backend = Backend(get_config(tmp_path))
+    repositories = [
+        ("OCA", "server-tools", "14.0", "16.0"),
+        ("OCA", "server-ux", "14.0", "16.0"),
+        ("OCA", "server-tools", "15.0", "16.0"),
+    ]
+    insert = """
+        INSERT INTO modules (
+            org, repo, from_version, to_version, module, status
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    """
+    upsert = f"""
+        {insert}
+        ON CONFLICT (org, repo, module, from_version, to_version)
+        DO UPDATE SET status=excluded.status;
+    """
+    with backend.transaction() as cr:
+        cr.executemany(
+            """
+            INSERT INTO repositories (org, name, from_version, to_version)
+            VALUES (?, ?, ?, ?);
+            """,
+            repositories,
+        )
+        # Insert
+        cr.executemany(
+            insert,
+            [
+                (*repository, f"module_{status}", status)
+                for repository in repositories
+                for status in (
+                    "available",
+                    "migrate",
+                    "to review",
+                    "port_commits",
+                )
+            ],
+        )
+    assert_stats(backend)
+    tools = repositories[0]
+    with backend.transaction() as cr:
+        # Upsert, of a new module and of an existing one
+        cr.execute(upsert, (*tools, "module_new", "migrate"))
+        cr.execute(upsert, (*tools, "module_available", "to review"))
+    assert_stats(backend)
+    with backend.transaction() as cr:
+        # Status change
+        cr.execute(
+            """
+            UPDATE modules SET status='available'
+            WHERE module='module_migrate';
+            """
+        )
+        # Replaced row, removed then inserted with the recursive triggers
+        cr.execute(
+            insert.replace("INSERT", "INSERT OR REPLACE"),
+            (*tools, "module_port_commits", "migrate"),
+        )
+    assert_stats(backend)
+    stats = backend.db.execute(
+        f"""
+        SELECT {", ".join(Backend._repositories_stats)}
+        FROM repositories
+        WHERE org=? AND name=? AND from_version=? AND to_version=?;
+        """,
+        tools,
+    ).fetchone()
+    assert stats == (5, 1, 2, 2, 0)
+    with backend.transaction() as cr:
+        # Delete
+        cr.execute("DELETE FROM modules WHERE module='module_to review';")
+        cr.execute("DELETE FROM modules WHERE repo='server-ux';")
+    assert_stats(backend)
+    stats = backend.db.execute(
+        f"""
+        SELECT {", ".join(Backend._repositories_stats)}
+        FROM versions WHERE from_version='14.0';
+        """
+    ).fetchone()
+    assert stats == (4, 1, 2, 1, 0)
+
+
+def test_rebuild_repositories_stats(tmp_path):
+    backend = Backend(get_config(tmp_path))
+    repository = ("OCA", "server-tools", "14.0", "16.0")
+    with backend.transaction() as cr:
+        cr.execute(
+            """
+            INSERT INTO repositories (org, name, from_version, to_version)
+            VALUES (?, ?, ?, ?);
+            """,
+            repository,
+        )
+        cr.executemany(
+            """
+            INSERT INTO modules (
+                org, repo, from_version, to_version, module, status
+            ) VALUES (?, ?, ?, ?, ?, ?);
+            """,
+            [
+                (*repository, "module_a", "migrate"),
+                (*repository, "module_b", "available"),
+            ],
+        )
+        # Stats out of sync, e.g. after a manual change of the database
+        cr.execute(
+            "UPDATE repositories SET nb_modules=5, nb_modules_migrated=0;"
+        )
+    assert backend.check_repositories_stats() == [repository]
+    generation = backend.get_generation()
+    backend.rebuild_repositories_stats()
+    assert_stats(backend)
+    assert backend.get_generation() > generation
@@ -0,0 +1,51 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import pytest
+
+
+@pytest.fixture
+def etag(client):
+    response = client.get("/api/versions")
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+
+@pytest.mark.parametrize(
+    "header",
+    ["{etag}", "W/{etag}", '"0", {etag}', '{etag},"0"', "*"],
+)
+def test_not_modified(client, etag, header):
+    response = client.get(
+        "/api/versions", headers={"If-None-Match": header.format(etag=etag)}
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+@pytest.mark.parametrize(
+    "header",
+    ['"0"', 'W/"0"', "{etag}0", '"{generation}0"'],
+)
+def test_modified(client, etag, header):
+    header = header.format(etag=etag, generation=etag.strip('"'))
+    response = client.get("/api/versions", headers={"If-None-Match": header})
+    assert response.status_code == 200
+
+
+def test_not_modified_invalid_params(client, etag):
+    headers = {"If-None-Match": etag}
+    response = client.get("/api/modules", params={"limit": 0}, headers=headers)
+    assert response.status_code == 422
+    response = client.get(
+        "/api/modules", params={"fields": "unknown"}, headers=headers
+    )
+    assert response.status_code == 400
+
+
+def test_new_generation(client, backend, etag):
+    with backend.transaction() as cr:
+        backend.bump_generation(cr)
+    response = client.get("/api/versions", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
@@ -0,0 +1,169 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import http.server
+import threading
+import time
+
+import pytest
+from oca_port.utils import github as oca_port_github
+
+from oca_port_scanner.scanner import github
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    """Answer requests with the rate limit headers set by the test."""
+
+    headers_sent = {}
+
+    def do_GET(self):
+        self.send_response(200)
+        for name, value in self.headers_sent.items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def github_url():
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), FakeGitHubHandler
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the delays waited by the buckets instead of sleeping."""
+    delays = []
+    monkeypatch.setattr(github.time, "sleep", delays.append)
+    return delays
+
+
+def test_bucket_budget(sleeps):
+    bucket = github.TokenBucket(2, 3600)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    # Budget spent: wait for a token to be refilled
+    delay = bucket.acquire()
+    assert 1700 < delay <= 1800
+    assert sleeps == [delay]
+    assert bucket.tokens_spent == 3
+    assert bucket.time_waited == delay
+
+
+def test_bucket_update(sleeps):
+    bucket = github.TokenBucket(5000, 3600)
+    bucket.update(0, time.time() + 30)
+    # Quota exhausted on GitHub side: wait for its reset
+    assert 29 < bucket.acquire() <= 30
+    bucket.update(10, time.time() - 1)
+    # Quota reset on GitHub side: the whole budget is available
+    assert bucket.acquire() == 0
+    assert bucket.tokens == pytest.approx(4999, abs=1)
+
+
+def test_bucket_exhausted(sleeps, monkeypatch):
+    clock = {"time": time.time(), "monotonic": time.monotonic()}
+    monkeypatch.setattr(github.time, "time", lambda: clock["time"])
+    monkeypatch.setattr(github.time, "monotonic", lambda: clock["monotonic"])
+    bucket = github.TokenBucket(5000, 3600)
+    bucket.update(0, clock["time"] + 1800)
+    # Time passes, but GitHub won't accept requests before the reset
+    clock["time"] += 10
+    clock["monotonic"] += 10
+    for __ in range(12):
+        assert bucket.acquire() == pytest.approx(1790)
+
+
+def test_rate_limiter_resources():
+    rate_limiter = github.RateLimiter({"search": (10, 60)})
+    rate_limiter.acquire("https://api.github.com/search/issues?q=test")
+    rate_limiter.acquire("https://api.github.com/repos/OCA/server-tools")
+    assert rate_limiter.metrics() == {
+        "core": {"tokens_spent": 1, "time_waited": 0},
+        "search": {"tokens_spent": 1, "time_waited": 0},
+    }
+    assert rate_limiter.buckets["search"].budget == 10
+    assert rate_limiter.buckets["core"].budget == 5000
+
+
+def test_rate_limiter_update():
+    rate_limiter = github.RateLimiter()
+    url = "https://api.github.com/repos/OCA/server-tools"
+    # No rate limit headers: nothing to synchronize
+    rate_limiter.update(url, {})
+    assert rate_limiter.buckets["core"].reset_at is None
+    # The resource reported by GitHub prevails over the URL
+    reset_at = int(time.time()) + 60
+    rate_limiter.update(
+        url,
+        {
+            "X-RateLimit-Remaining": "3",
+            "X-RateLimit-Reset": str(reset_at),
+            "X-RateLimit-Resource": "search",
+        },
+    )
+    assert rate_limiter.buckets["search"].tokens == 3
+    assert rate_limiter.buckets["search"].reset_at == reset_at
+    assert rate_limiter.buckets["core"].reset_at is None
+
+
+def test_throttled_requests(github_url, sleeps, monkeypatch):
+    monkeypatch.setattr(oca_port_github, "requests", oca_port_github.requests)
+    rate_limiter = github.RateLimiter()
+    github.install(rate_limiter)
+    assert isinstance(oca_port_github.requests, github.ThrottledRequests)
+    requests = oca_port_github.requests
+    reset_at = int(time.time()) + 60
+    monkeypatch.setattr(
+        FakeGitHubHandler,
+        "headers_sent",
+        {
+            "X-RateLimit-Remaining": 0,
+            "X-RateLimit-Reset": reset_at,
+            "X-RateLimit-Resource": "core",
+        },
+    )
+    response = requests.get(f"{github_url}/repos/OCA/server-tools")
+    assert response.json() == {}
+    assert sleeps == []
+    bucket = rate_limiter.buckets["core"]
+    assert bucket.tokens < 1
+    assert bucket.reset_at == reset_at
+    # Next request waits for the reset announced by GitHub
+    requests.get(f"{github_url}/repos/OCA/server-tools")
+    assert len(sleeps) == 1
+    assert 58 < sleeps[0] <= 60
+    # The rest of the 'requests' API is still available
+    assert requests.exceptions.HTTPError
+
+
+def test_throttled_requests_shared(github_url, sleeps, monkeypatch):
+    """The rate limiter is shared by processes through the manager."""
+    manager = github.Manager()
+    manager.start()
+    try:
+        rate_limiter = manager.RateLimiter()
+        requests = github.ThrottledRequests(rate_limiter)
+        monkeypatch.setattr(
+            FakeGitHubHandler,
+            "headers_sent",
+            {"X-RateLimit-Remaining": 42, "X-RateLimit-Resource": "search"},
+        )
+        requests.get(f"{github_url}/search/issues")
+        metrics = rate_limiter.metrics()
+        assert metrics["search"]["tokens_spent"] == 1
+        assert metrics["core"]["tokens_spent"] == 0
+    finally:
+        manager.shutdown()
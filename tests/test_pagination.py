@@ -0,0 +1,107 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import base64
+import json
+
+import pytest
+
+from oca_port_scanner.http.models import MODULES_KEY, decode_cursor
+
+MODULES = [f"module_{number:02d}" for number in range(25)]
+
+
+@pytest.fixture
+def modules(backend):
+    with backend.transaction() as cr:
+        cr.executemany(
+            """
+            INSERT INTO repositories(org, name, from_version, to_version)
+            VALUES ('OCA', ?, '14.0', '16.0');
+            """,
+            [("server-tools",), ("server-ux",)],
+        )
+        cr.executemany(
+            """
+            INSERT INTO modules(
+                org, repo, module, from_version, to_version, process
+            )
+            VALUES ('OCA', ?, ?, '14.0', '16.0', 'migrate');
+            """,
+            [
+                ("server-tools" if number % 2 else "server-ux", module)
+                for number, module in enumerate(MODULES)
+            ],
+        )
+        backend.bump_generation(cr)
+    return MODULES
+
+
+def encode(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def test_pages(client, modules):
+    names = []
+    params = {"limit": 10, "fields": "name"}
+    while True:
+        response = client.get("/api/modules", params=params)
+        assert response.status_code == 200
+        names += [module["name"] for module in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            assert "Link" not in response.headers
+            break
+        assert 'rel="next"' in response.headers["Link"]
+        params["after"] = response.headers["X-Next-Cursor"]
+    # Each module once, in the order of the key (repository then name)
+    assert len(names) == len(modules)
+    assert names == [
+        module
+        for repo in ("server-tools", "server-ux")
+        for number, module in enumerate(modules)
+        if (repo == "server-tools") == bool(number % 2)
+    ]
+
+
+def test_pages_models(client, modules):
+    response = client.get("/api/modules", params={"limit": 20})
+    cursor = response.headers["X-Next-Cursor"]
+    assert decode_cursor(cursor, MODULES_KEY)[2] == response.json()[-1]["name"]
+    response = client.get(
+        "/api/modules", params={"limit": 20, "after": cursor}
+    )
+    assert len(response.json()) == 5
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        encode({"org": "OCA"}),
+        encode(["OCA", "server-tools"]),
+        encode([{}, [], "module", "14.0", "16.0"]),
+        encode(["OCA", "server-tools", 1.5, "14.0", "16.0"]),
+        encode(["OCA", "server-tools", True, "14.0", "16.0"]),
+    ],
+)
+def test_invalid_cursor(client, modules, cursor):
+    response = client.get("/api/modules", params={"limit": 1, "after": cursor})
+    assert response.status_code == 400
+
+
+def test_modules_repositories(client, modules, monkeypatch):
+    from oca_port_scanner.http import models
+
+    # Repositories are loaded by chunk of modules read
+    monkeypatch.setattr(models, "FETCH_SIZE", 3)
+    response = client.get("/api/modules", params={"limit": 10})
+    repositories = [module["repository"] for module in response.json()]
+    assert len(repositories) == 10
+    assert {repository["fullname"] for repository in repositories} == {
+        "OCA/server-tools"
+    }
+    response = client.get("/api/modules", params={"repo": "server-ux"})
+    for module in response.json():
+        assert module["repository"]["name"] == "server-ux"
+        assert module["repository"]["nb_modules"] == 13
@@ -0,0 +1,152 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import subprocess
+import types
+
+import pytest
+
+from oca_port_scanner.backend import Backend
+from oca_port_scanner.scanner import repo as repo_module
+from oca_port_scanner.scanner.repo import GitRepoCache, Repo
+
+
+def git(path, *args):
+    return subprocess.run(
+        ["git", *args], cwd=path, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def commit(path, files, removed=()):
+    """Commit the `files` contents and the removal of `removed` paths."""
+    for name, content in files.items():
+        path.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        path.joinpath(name).write_text(content)
+    for name in removed:
+        git(path, "rm", "-rq", name)
+    git(path, "add", "-A")
+    git(path, "commit", "-qm", "Update")
+    return git(path, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path.joinpath("OCA", "server-tools")
+    path.mkdir(parents=True)
+    git(path, "init", "-q")
+    git(path, "config", "user.name", "Test")
+    git(path, "config", "user.email", "test@example.com")
+    app = types.SimpleNamespace(
+        storage=types.SimpleNamespace(repositories_path=tmp_path),
+        git_repos=GitRepoCache(1),
+        backend=Backend(
+            {"options": {"database_path": str(tmp_path.joinpath("data.db"))}}
+        ),
+        branches_matrix=[("14.0", "16.0")],
+        analysis_pool=None,
+    )
+    repo = Repo(app, "OCA/server-tools")
+    yield repo
+    repo.close()
+    app.git_repos.clear()
+
+
+def test_modules_updated(repo):
+    first = commit(
+        repo.path,
+        {
+            "module_a/__init__.py": "",
+            "module_b/__init__.py": "",
+            "module_c/__init__.py": "",
+            "module_d/i18n/fr.po": "",
+            "setup/module_a/setup.py": "",
+            ".github/workflows/test.yml": "",
+            "README.md": "",
+        },
+    )
+    assert repo._get_modules_updated(None, first) == {
+        "module_a",
+        "module_b",
+        "module_c",
+        "module_d",
+    }
+    second = commit(
+        repo.path,
+        {
+            # Modified, added (with a non-ASCII name)
+            "module_a/models.py": "",
+            "module_é/__init__.py": "",
+            # Translations only
+            "module_d/i18n/de.po": "",
+            # Out of modules
+            "setup/module_a/setup.py": "# Updated",
+            ".github/workflows/test.yml": "# Updated",
+            "README.md": "Updated",
+            "fr.po": "",
+        },
+        removed=["module_b"],
+    )
+    git(repo.path, "mv", "module_c", "module_renamed")
+    third = commit(repo.path, {})
+    assert repo._get_modules_updated(first, second) == {
+        "module_a",
+        "module_b",
+        "module_d",
+        "module_é",
+    }
+    # Renamed modules: both the old and new names
+    assert repo._get_modules_updated(second, third) == {
+        "module_c",
+        "module_renamed",
+    }
+    assert repo._get_modules_updated(third, third) == set()
+
+
+def push(repo, branch, files):
+    """Commit `files` and update the remote `branch` with it."""
+    sha = commit(repo.path, files)
+    git(repo.path, "update-ref", f"refs/remotes/origin/{branch}", sha)
+
+
+def test_scan_cache(repo, monkeypatch):
+    analyzed = []
+
+    def analyze_module(params):
+        analyzed.append(params["addon"])
+        # Modules that can't be analyzed
+        if params["addon"] == "module_b":
+            return None, 0
+        return {"process": "migrate", "results": {}}, 0
+
+    monkeypatch.setattr(repo_module, "analyze_module", analyze_module)
+    git(repo.path, "remote", "add", "origin", str(repo.path))
+    files = {"module_a/__init__.py": "", "module_b/__init__.py": ""}
+    push(repo, "14.0", files)
+    git(repo.path, "update-ref", "refs/remotes/origin/16.0", "HEAD")
+    repo.scan()
+    assert sorted(analyzed) == ["module_a", "module_b"]
+    assert repo.cache_stats == {"misses": 2}
+    # Only translations updated: the results of `module_a` are still valid,
+    # but `module_b` was not analyzed so it has no cached results
+    analyzed.clear()
+    push(repo, "14.0", {"module_a/i18n/fr.po": "", "module_b/i18n/fr.po": ""})
+    repo.scan()
+    assert analyzed == ["module_b"]
+    assert repo.cache_stats == {"misses": 3, "hits": 1}
+    # Code updated
+    analyzed.clear()
+    push(repo, "14.0", {"module_a/models.py": ""})
+    repo.scan()
+    assert analyzed == ["module_a"]
+    assert repo.cache_stats == {"misses": 4, "hits": 1}
+    # New version of oca-port, whose results may differ
+    analyzed.clear()
+    monkeypatch.setattr(repo_module, "OCA_PORT_VERSION", "0.0.0")
+    push(repo, "14.0", {"module_a/i18n/de.po": ""})
+    repo.scan()
+    assert analyzed == ["module_a"]
+    assert repo.cache_stats == {"misses": 5, "hits": 1}
+    status = repo.app.backend.db.execute(
+        "SELECT module, status FROM modules ORDER BY module;"
+    ).fetchall()
+    assert status == [("module_a", "migrate")]
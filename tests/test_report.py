@@ -0,0 +1,168 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import csv
+import io
+
+import pytest
+
+from oca_port_scanner.http import models
+
+MODULES = ["base_technical_user", "base_name_search_improved", "mis", "mass"]
+
+
+@pytest.fixture
+def modules(backend):
+    with backend.transaction() as cr:
+        cr.execute(
+            """
+            INSERT INTO repositories(org, name, from_version, to_version)
+            VALUES ('OCA', 'server-tools', '14.0', '16.0');
+            """
+        )
+        cr.executemany(
+            """
+            INSERT INTO modules(
+                org, repo, module, from_version, to_version, process
+            )
+            VALUES ('OCA', 'server-tools', ?, '14.0', '16.0', 'migrate');
+            """,
+            [(module,) for module in MODULES],
+        )
+        backend.bump_generation(cr)
+    return MODULES
+
+
+def get_report(client, modules):
+    response = client.post(
+        "/report", data={"versions": "14.0,16.0", "modules": modules}
+    )
+    assert response.status_code == 200
+    return list(csv.DictReader(io.StringIO(response.text)))
+
+
+def test_report(client, modules):
+    rows = get_report(client, "base_technical_user,base_tecnical_user,ms")
+    assert [
+        (row["repository"], row["module"], row["info"]) for row in rows
+    ] == [
+        ("OCA/server-tools", "base_technical_user", ""),
+        ("", "", ""),
+        ("UNKNOWN", "", ""),
+        ("", "base_tecnical_user", "Did you mean: base_technical_user?"),
+        # Names too short to have trigrams get suggestions too
+        ("", "ms", "Did you mean: mis, mass?"),
+    ]
+
+
+def test_suggest_modules(modules):
+    suggestions = models.suggest_modules(
+        ["base_tecnical_user", "ms", "mas", "", "unrelated"]
+    )
+    assert suggestions == {
+        "base_tecnical_user": ["base_technical_user"],
+        "ms": ["mis", "mass"],
+        "mas": ["mass"],
+        "": [],
+        "unrelated": [],
+    }
+
+
+def test_suggestions_limit(client, modules, monkeypatch):
+    monkeypatch.setattr(models, "SUGGESTED_MODULES_SIZE", 1)
+    rows = get_report(client, "base_tecnical_user,ms")
+    infos = {row["module"]: row["info"] for row in rows if row["module"]}
+    assert infos == {
+        "base_tecnical_user": "Did you mean: base_technical_user?",
+        "ms": "",
+    }
+
+
+def test_report_releases_connection(backend, modules, monkeypatch):
+    monkeypatch.setattr(models, "CSV_CHUNK_SIZE", 1)
+    content = models.Module.get_csv("14.0", "16.0", MODULES + ["unknown"])
+    assert "base_technical_user" in next(content)
+    # No reader is held while the rest of the report is sent
+    assert backend._readers.qsize() == backend._readers_count
+    assert all(not con.in_transaction for con in backend._readers.queue)
+    assert "unknown" in "".join(content)
+
+
+def test_api_report(client, backend, modules):
+    urls = ["https://github.com/OCA/server-tools/pull/1", "https://pr/2"]
+    with backend.transaction() as cr:
+        cr.execute(
+            """
+            INSERT INTO repositories(org, name, from_version, to_version)
+            VALUES ('OCA', 'server-tools', '15.0', '16.0');
+            """
+        )
+        cr.execute(
+            """
+            INSERT INTO modules(
+                org,
+                repo,
+                module,
+                from_version,
+                to_version,
+                process,
+                status,
+                nb_missing_commits,
+                pr_urls
+            )
+            VALUES (
+                'OCA', 'server-tools', 'mis', '15.0', '16.0',
+                'port_commits', 'port_commits', 3, ?
+            );
+            """,
+            ("\n".join(urls),),
+        )
+        backend.bump_generation(cr)
+    response = client.post(
+        "/api/report",
+        json={
+            # Duplicates are reported once
+            "modules": ["mis", "unknown", "mis", "base_technical_user"],
+            "versions": [["14.0", "16.0"], ["15.0", "16.0"]],
+        },
+    )
+    assert response.status_code == 200
+    module = {
+        "repository": "OCA/server-tools",
+        "status": None,
+        "nb_missing_commits": 0,
+        "pr_urls": [],
+    }
+    assert response.json() == [
+        {
+            "from_version": "14.0",
+            "to_version": "16.0",
+            "modules": [
+                dict(module, name="mis"),
+                dict(module, name="base_technical_user"),
+            ],
+            "unknown_modules": ["unknown"],
+        },
+        {
+            "from_version": "15.0",
+            "to_version": "16.0",
+            "modules": [
+                dict(
+                    module,
+                    name="mis",
+                    status="port_commits",
+                    nb_missing_commits=3,
+                    pr_urls=urls,
+                ),
+            ],
+            # Modules known for another pair of versions only
+            "unknown_modules": ["unknown", "base_technical_user"],
+        },
+    ]
+
+
+def test_api_report_no_versions(client, modules):
+    response = client.post(
+        "/api/report", json={"modules": ["mis"], "versions": []}
+    )
+    assert response.status_code == 422
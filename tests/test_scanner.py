@@ -0,0 +1,49 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import collections
+import time
+
+import pytest
+
+REPOSITORIES = [f"OCA/repository-{number}" for number in range(6)]
+
+
+@pytest.fixture
+def scans(scanner, monkeypatch):
+    """Record the repositories scanned, each scan taking some time."""
+    scanned = []
+
+    def scan_repository(repository, branches=None):
+        time.sleep(0.05)
+        scanned.append(repository)
+        return collections.Counter()
+
+    monkeypatch.setattr(scanner, "_scan_repository", scan_repository)
+    return scanned
+
+
+def stop(*args):
+    # As the handler of SIGTERM and SIGINT does
+    raise SystemExit(0)
+
+
+def test_stop_cycle(scanner, scans, monkeypatch):
+    monkeypatch.setattr(
+        scanner.scheduler, "get_due_repositories", lambda: REPOSITORIES
+    )
+    monkeypatch.setattr(scanner.scheduler, "reschedule", stop)
+    with pytest.raises(SystemExit):
+        scanner._scan_repositories()
+    # Pending scans are cancelled, only the running ones are completed
+    assert len(scans) <= scanner.workers + 1
+
+
+def test_stop_jobs(scanner, scans, monkeypatch):
+    scanner.repositories = REPOSITORIES
+    jobs = {repository: {"16.0"} for repository in REPOSITORIES}
+    monkeypatch.setattr(scanner.scheduler, "get_jobs", lambda: jobs)
+    monkeypatch.setattr(scanner.scheduler, "reschedule", stop)
+    with pytest.raises(SystemExit):
+        scanner._run_scan_jobs()
+    assert len(scans) <= scanner.workers + 1
@@ -0,0 +1,99 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import types
+
+import pytest
+
+from oca_port_scanner.backend import Backend
+from oca_port_scanner.scanner import scheduler as scheduler_module
+from oca_port_scanner.scanner.scheduler import Scheduler
+
+NOW = 1_700_000_000.0
+HOUR = 3600
+DAY = 24 * HOUR
+REPOSITORIES = ["OCA/server-tools", "OCA/server-ux", "OCA/web"]
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler_module.time, "time", lambda: NOW)
+    options = {
+        "database_path": str(tmp_path.joinpath("data.db")),
+        "scan_min_interval": 600,
+        "scan_max_interval": DAY,
+    }
+    app = types.SimpleNamespace(
+        config={"options": options},
+        backend=Backend({"options": options}),
+        repositories=REPOSITORIES,
+    )
+    return Scheduler(app)
+
+
+def set_last_change(scheduler, repository, last_change_at):
+    org, name = repository.split("/")
+    with scheduler.app.backend.transaction() as cr:
+        cr.execute(
+            """
+            INSERT INTO repositories(
+                org, name, from_version, to_version, last_change_at
+            ) VALUES (?, ?, '14.0', '16.0', ?);
+            """,
+            (org, name, last_change_at),
+        )
+
+
+@pytest.mark.parametrize(
+    "last_change_at, interval",
+    [
+        # Active repository: the minimum interval
+        (NOW, 600),
+        (NOW - HOUR / 2, 600),
+        # Proportional to the time elapsed since the last change
+        (NOW - HOUR, HOUR / 4),
+        (NOW - 8 * HOUR, 2 * HOUR),
+        # Dormant repository: the maximum interval
+        (NOW - 30 * DAY, DAY),
+        # No branches found
+        (None, DAY),
+    ],
+)
+def test_get_interval(scheduler, last_change_at, interval):
+    assert scheduler._get_interval(NOW, last_change_at) == interval
+
+
+def test_reschedule(scheduler):
+    set_last_change(scheduler, "OCA/server-tools", NOW - 8 * HOUR)
+    set_last_change(scheduler, "OCA/server-ux", None)
+    # Never scanned: due immediately
+    assert scheduler.get_queue() == [(repo, 0) for repo in REPOSITORIES]
+    assert scheduler.get_due_repositories() == REPOSITORIES
+    assert scheduler.reschedule("OCA/server-tools") == NOW + 2 * HOUR
+    # 'last_change_at' not set, or no repository entry at all
+    assert scheduler.reschedule("OCA/server-ux") == NOW + DAY
+    assert scheduler.reschedule("OCA/web") == NOW + DAY
+    assert scheduler.get_due_repositories() == []
+    set_last_change(scheduler, "OCA/web", NOW - HOUR / 2)
+    scheduler.reschedule("OCA/web")
+    assert scheduler.get_queue() == [
+        ("OCA/web", NOW + 600),
+        ("OCA/server-tools", NOW + 2 * HOUR),
+        ("OCA/server-ux", NOW + DAY),
+    ]
+
+
+def test_due_repositories(scheduler, monkeypatch):
+    set_last_change(scheduler, "OCA/server-tools", NOW - 8 * HOUR)
+    set_last_change(scheduler, "OCA/web", NOW - HOUR)
+    scheduler.reschedule("OCA/server-tools")
+    scheduler.reschedule("OCA/web")
+    monkeypatch.setattr(scheduler_module.time, "time", lambda: NOW + HOUR)
+    # The repository never scanned first, then the most overdue ones
+    assert scheduler.get_due_repositories() == ["OCA/server-ux", "OCA/web"]
+    monkeypatch.setattr(scheduler_module.time, "time", lambda: NOW + DAY)
+    assert scheduler.get_due_repositories() == [
+        "OCA/server-ux",
+        "OCA/web",
+        "OCA/server-tools",
+    ]
@@ -0,0 +1,89 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import pytest
+
+from oca_port_scanner.http import models
+
+MODULES = {
+    "OCA/server-tools": [
+        "auditlog",
+        "base_name_search_improved",
+        "base_technical_user",
+    ],
+    "OCA/web": ["web_responsive", "web_widget_x2many"],
+    "OCA/mis-builder": ["mis_builder", "mis_builder_budget"],
+}
+
+
+@pytest.fixture
+def modules(backend):
+    with backend.transaction() as cr:
+        for repository, modules in MODULES.items():
+            org, name = repository.split("/")
+            for version in ("14.0", "15.0"):
+                cr.execute(
+                    """
+                    INSERT INTO repositories(
+                        org, name, from_version, to_version
+                    ) VALUES (?, ?, ?, '16.0');
+                    """,
+                    (org, name, version),
+                )
+                cr.executemany(
+                    """
+                    INSERT INTO modules(
+                        org, repo, module, from_version, to_version
+                    ) VALUES (?, ?, ?, ?, '16.0');
+                    """,
+                    [(org, name, module, version) for module in modules],
+                )
+        backend.bump_generation(cr)
+    return MODULES
+
+
+def get_names(results):
+    return [result["name"] for result in results]
+
+
+def test_search_prefix(modules):
+    results = models.search_modules("mis_")
+    # Modules starting with the query first, even less similar ones
+    assert get_names(results)[:2] == ["mis_builder", "mis_builder_budget"]
+    assert results[0]["repository"] == "OCA/mis-builder"
+    assert results[0]["score"] > results[1]["score"]
+    # Each module is listed once, whatever its number of versions
+    assert len(get_names(results)) == len(set(get_names(results)))
+
+
+def test_search_typo(modules):
+    results = models.search_modules("base_tecnical_usr")
+    assert get_names(results)[0] == "base_technical_user"
+    results = models.search_modules(" Web_Responsiv ")
+    assert get_names(results)[0] == "web_responsive"
+
+
+def test_search_repository(modules):
+    results = models.search_modules("server-tools")
+    assert get_names(results)[:3] == MODULES["OCA/server-tools"]
+    assert {result["score"] for result in results[:3]} == {1}
+
+
+def test_search_empty(modules):
+    assert models.search_modules(" ") == []
+
+
+def test_api_search(client, modules):
+    response = client.get("/api/search", params={"q": "web", "limit": 1})
+    assert response.status_code == 200
+    assert response.json() == [
+        {"name": "web_responsive", "repository": "OCA/web", "score": 1.0}
+    ]
+    response = client.get("/api/search", params={"q": "web"})
+    assert get_names(response.json())[:2] == [
+        "web_responsive",
+        "web_widget_x2many",
+    ]
+    for params in ({"q": ""}, {"q": "web", "limit": 0}):
+        response = client.get("/api/search", params=params)
+        assert response.status_code == 422
@@ -0,0 +1,123 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import gzip
+import json
+
+import pytest
+
+from oca_port_scanner.backend import PR_FIELDS
+
+PR = {
+    "title": "[16.0][MIG] base_technical_user",
+    "number": 42,
+    "url": "https://github.com/OCA/server-tools/pull/42",
+    "author": "someone",
+    "merged_at": None,
+    "ref": "refs/pull/42/head",
+}
+
+
+@pytest.fixture
+def exports(backend):
+    from oca_port_scanner import http
+
+    with backend.transaction() as cr:
+        cr.execute(
+            """
+            INSERT INTO repositories(org, name, from_version, to_version)
+            VALUES ('OCA', 'server-tools', '14.0', '16.0');
+            """
+        )
+        cr.execute(
+            """
+            INSERT INTO modules(
+                org, repo, module, from_version, to_version, process,
+                existing_pr
+            )
+            VALUES (
+                'OCA', 'server-tools', 'base_technical_user', '14.0', '16.0',
+                'migrate', ?
+            );
+            """,
+            (json.dumps(PR),),
+        )
+        backend.bump_generation(cr)
+    assert http.exports.export()
+    return http.exports
+
+
+def test_pr_fields():
+    from oca_port_scanner.http.models import PR
+
+    assert tuple(PR.model_fields) == PR_FIELDS
+
+
+def test_snapshot(client, exports):
+    response = client.get("/api/snapshots")
+    url = response.json()["snapshots"][0]["urls"]["json"]
+    response = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    modules = response.json()
+    assert modules[0]["existing_pr"] == {
+        field: PR[field] for field in PR_FIELDS
+    }
+    # Same data as the API
+    response = client.get("/api/modules", params={"limit": 1})
+    assert response.json()[0]["existing_pr"] == modules[0]["existing_pr"]
+
+
+def test_snapshot_etags(client, exports):
+    url = "/api/snapshots/14.0/16.0.json"
+    etags = {}
+    for encoding in ("gzip", "identity"):
+        headers = {"Accept-Encoding": encoding}
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        etags[encoding] = response.headers["ETag"]
+        headers["If-None-Match"] = etags[encoding]
+        response = client.get(url, headers=headers)
+        assert response.status_code == 304
+    # Each representation has its own validator
+    assert etags["gzip"] != etags["identity"]
+    response = client.get(
+        url,
+        headers={
+            "Accept-Encoding": "gzip",
+            "If-None-Match": etags["identity"],
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_snapshot_gzip(client, exports):
+    path, __ = exports.get_file("14.0", "16.0", "csv")
+    response = client.get(
+        "/api/snapshots/14.0/16.0.csv", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.text == gzip.decompress(path.read_bytes()).decode()
+
+
+def test_requests_metrics(client, exports, monkeypatch):
+    from oca_port_scanner import http
+    from oca_port_scanner.http.cache import ResponseCache
+
+    monkeypatch.setattr(http.REQUEST_SECONDS, "_values", {})
+    monkeypatch.setattr(http, "response_cache", ResponseCache(8))
+    client.get("/api/snapshots/14.0/16.0.json")
+    client.get("/api/snapshots/14.0/16.0.csv")
+    # The second response is served from the cache
+    client.get("/api/versions")
+    client.get("/api/versions")
+    client.get("/api/unknown")
+    labels = [dict(key) for key in http.REQUEST_SECONDS._values]
+    assert sorted(labels, key=lambda item: item["path"]) == [
+        {
+            "method": "GET",
+            "path": "/api/snapshots/{from_version}/{to_version}.{format_}",
+            "status": 200,
+        },
+        {"method": "GET", "path": "/api/versions", "status": 200},
+        {"method": "GET", "path": "other", "status": 404},
+    ]
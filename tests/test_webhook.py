@@ -0,0 +1,146 @@
+# Copyright 2023 Camptocamp SA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl)
+
+import collections
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+from .conftest import WEBHOOK_SECRET
+
+PUSH_PAYLOAD = {
+    "ref": "refs/heads/16.0",
+    "repository": {"full_name": "OCA/server-tools"},
+}
+
+
+def post_push(client, payload, secret=WEBHOOK_SECRET, event="push"):
+    body = json.dumps(payload).encode()
+    signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    headers = {
+        "Content-Type": "application/json",
+        "X-GitHub-Event": event,
+        "X-Hub-Signature-256": f"sha256={signature}",
+    }
+    return client.post("/webhook/github", content=body, headers=headers)
+
+
+def get_jobs(backend):
+    with backend.reader() as cr:
+        cr.execute("SELECT repository, branch FROM scan_jobs;")
+        return cr.fetchall()
+
+
+def test_webhook_invalid_signature(client, backend):
+    response = post_push(client, PUSH_PAYLOAD, secret="wrong")
+    assert response.status_code == 403
+    response = client.post(
+        "/webhook/github",
+        json=PUSH_PAYLOAD,
+        headers={"X-GitHub-Event": "push"},
+    )
+    assert response.status_code == 403
+    assert get_jobs(backend) == []
+
+
+def test_webhook_push(client, backend):
+    response = post_push(client, PUSH_PAYLOAD)
+    assert response.status_code == 200
+    assert response.json() == {"queued": True}
+    assert get_jobs(backend) == [("OCA/server-tools", "16.0")]
+
+
+def test_webhook_ignored(client, backend):
+    # Other events, unknown branches and repositories are not queued
+    assert post_push(client, PUSH_PAYLOAD, event="ping").json() == {
+        "queued": False
+    }
+    payload = dict(PUSH_PAYLOAD, ref="refs/heads/12.0")
+    assert post_push(client, payload).json() == {"queued": False}
+    payload = dict(PUSH_PAYLOAD, repository={"full_name": "OCA/web"})
+    assert post_push(client, payload).json() == {"queued": False}
+    assert get_jobs(backend) == []
+    assert post_push(client, {"ref": "refs/heads/16.0"}).status_code == 400
+
+
+class FakeRepo:
+    """Repository whose scan is blocked until `released` is set."""
+
+    released = threading.Event()
+    scanned = []
+
+    def __init__(self, app, name):
+        self.name = name
+        self.cache_stats = collections.Counter()
+
+    def fetch(self, branches):
+        pass
+
+    def scan(self, branches):
+        if self.name == "OCA/slow":
+            self.released.wait(10)
+        self.scanned.append(self.name)
+
+    def close(self):
+        pass
+
+
+def test_scan_jobs_during_cycle(client, backend, scanner, monkeypatch):
+    from oca_port_scanner.scanner import app
+
+    monkeypatch.setattr(app, "Repo", FakeRepo)
+    monkeypatch.setattr(FakeRepo, "released", threading.Event())
+    monkeypatch.setattr(FakeRepo, "scanned", [])
+    monkeypatch.setattr(
+        scanner.scheduler, "get_due_repositories", lambda: ["OCA/slow"]
+    )
+    scanner.jobs_tick = 0.05
+    scanner._jobs_thread.start()
+    cycle = threading.Thread(target=scanner._scan_repositories)
+    cycle.start()
+    try:
+        post_push(client, PUSH_PAYLOAD)
+        for __ in range(100):
+            if FakeRepo.scanned:
+                break
+            time.sleep(0.05)
+        # Pushed branches are scanned without waiting for the cycle
+        assert FakeRepo.scanned == ["OCA/server-tools"]
+        assert cycle.is_alive()
+    finally:
+        FakeRepo.released.set()
+        cycle.join()
+        scanner._stopping.set()
+        scanner._jobs_thread.join()
+    assert FakeRepo.scanned == ["OCA/server-tools", "OCA/slow"]
+
+
+def test_scan_jobs_run(client, backend, scanner, monkeypatch):
+    scans = []
+    monkeypatch.setattr(
+        scanner,
+        "_scan_repository",
+        lambda repository, branches=None: scans.append((repository, branches)),
+    )
+    post_push(client, PUSH_PAYLOAD)
+    scanner._run_scan_jobs()
+    assert scans == [("OCA/server-tools", ["16.0"])]
+    assert get_jobs(backend) == []
+    # The regular scan of the repository is postponed
+    assert scanner.scheduler.get_due_repositories() == []
+    scanner._run_scan_jobs()
+    assert len(scans) == 1
+
+
+def test_scan_jobs_failed(client, backend, scanner, monkeypatch):
+    def scan_repository(repository, branches=None):
+        raise RuntimeError("Scan failed")
+
+    monkeypatch.setattr(scanner, "_scan_repository", scan_repository)
+    post_push(client, PUSH_PAYLOAD)
+    scanner._run_scan_jobs()
+    # Failed jobs are dropped, the regular scan catching up later
+    assert get_jobs(backend) == []
+    assert scanner.scheduler.get_due_repositories() == ["OCA/server-tools"]